@@ -0,0 +1,263 @@
+import os
+import csv
+import json
+import hashlib
+import argparse
+import collections
+from datetime import datetime
+from database import Db
+from eval_cache import EvalCache
+from opening_tree import OpeningTree
+from blunder_scoring import BlunderScorer
+from extract_blunders_2 import evaluate_nodes, generate_good_openings
+from eval_service import EVAL_SERVICE
+from metrics import TREE_NODES, stage
+import parquet_store
+import tree_store
+
+# Blunders and good openings kept per job
+BATCH_TOP = int(os.getenv("BATCH_TOP", 10))
+# Results are kept per window when the persisted bucket trees are used, keyed by the bucket files and their
+# modification times. Updating the trees (tree_store.py --update) only rewrites the buckets that got new games,
+# so only the windows covering them are merged, evaluated and scored again
+BATCH_CACHE = os.getenv("BATCH_CACHE", "on")
+
+CSV_COLUMNS = ["desired_elo", "elo_buffer", "color", "starting_moves", "games", "rank", "fen", "pos_prob",
+               "blunder_count", "count", "blunder_prob", "next_moves", "openings"]
+
+# One analysis, the same parameters extract_blunders_2.py asks for
+Job = collections.namedtuple("Job", ["desired_elo", "elo_buffer", "color", "starting_moves"],
+                             defaults=[200, "none", "none"])
+
+
+# Runs many jobs in one process, sharing the games, trees, evaluation cache and engine pool between them
+# The games of all jobs are read in one scan into per elo bucket trees (or the persisted bucket trees are used),
+# and each job's tree is merged from its window's buckets like tree_store.load_tree. Jobs with the same window
+# and starting moves share one tree and one round of evaluations, only their scoring differs
+class BatchAnalysis:
+    def __init__(self, time_controls=None, top=BATCH_TOP):
+        self.DB = Db()
+        self.eval_cache = EvalCache(self.DB)
+        self.time_controls = time_controls
+        self.top = top
+        self.buckets = dict()  # Key: (time control class, elo bucket), Value: OpeningTree
+        self.bucket_paths = dict()  # Same keys, Value: tree file, only when the persisted trees are used
+
+    # Read the bucket trees covering every job's window
+    def load_buckets(self, jobs):
+        persisted = tree_store.list_buckets()
+        if persisted:
+            # Bucket files are only read while merging, so map them instead of loading them
+            self.buckets = {key: OpeningTree.open(path) for key, path in persisted.items()}
+            self.bucket_paths = persisted
+            return
+
+        # Whole buckets, as windows are rounded to them
+        min_elo = min(tree_store.elo_bucket(job.desired_elo - job.elo_buffer) for job in jobs)
+        max_elo = max(tree_store.elo_bucket(job.desired_elo + job.elo_buffer) for job in jobs) + tree_store.BUCKET_SIZE
+        if parquet_store.has_games():
+            rows = parquet_store.load_rows(min_elo, max_elo)
+        else:
+            rows = tree_store.stream_rows(self.DB, min_elo, max_elo)
+        self.buckets = tree_store.add_rows(dict(), rows)
+        TREE_NODES.inc(sum(len(tree) for tree in self.buckets.values()))
+
+    # Jobs sharing a tree, as {(bucket keys, starting moves): [job indexes]}
+    def group_jobs(self, jobs):
+        groups = dict()
+        for index, job in enumerate(jobs):
+            keys = tuple(tree_store.window_buckets(self.buckets, job.desired_elo, job.elo_buffer, self.time_controls))
+            starting_moves = job.starting_moves.lower() if job.starting_moves != "none" else "none"
+            groups.setdefault((keys, starting_moves), list()).append(index)
+        return groups
+
+    def opening_tree(self, keys, starting_moves):
+        prefix = starting_moves.split() if starting_moves != "none" else None
+        opening_tree = OpeningTree()
+        for key in keys:
+            opening_tree.merge(self.buckets[key], prefix)
+        return opening_tree
+
+    # File of the results of a window by color, None when the results can't be cached
+    # Scores with evaluations still missing (EVAL_SERVICE=partial) are never cached
+    def cache_path(self, keys, starting_moves):
+        if BATCH_CACHE != "on" or EVAL_SERVICE == "partial" or not self.bucket_paths:
+            return None
+        window = json.dumps([[[self.bucket_paths[key], os.stat(self.bucket_paths[key]).st_mtime_ns] for key in keys],
+                             starting_moves, self.top]).encode()
+        return os.path.join(tree_store.TREE_DIR, "results", hashlib.sha1(window).hexdigest() + ".json")
+
+    def cached_results(self, path):
+        if path is None or not os.path.exists(path):
+            return dict()
+        with open(path) as f:
+            return json.load(f)
+
+    def save_results(self, path, results):
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(results, f)
+        os.replace(path + ".tmp", path)
+
+    # Score one color over a scorer whose evaluations are set, returns the results of a job with that color
+    def analyse(self, scorer, color):
+        blunder_dict, fen_dict = scorer.blunder_dict(scorer.score(color), fen_limit=self.top)
+        good_openings = generate_good_openings(blunder_dict)
+        blunders = list()
+        for key, (pos_prob, blunder_count, count, next_moves, openings) in list(blunder_dict.items())[:self.top]:
+            blunders.append({
+                "fen": fen_dict[key],
+                "pos_prob": pos_prob,
+                "blunder_count": blunder_count,
+                "count": count,
+                "blunder_prob": blunder_count / count,
+                "next_moves": next_moves,
+                "openings": sorted(openings),
+            })
+        return {
+            "games": int(scorer.tree.count[0]),
+            "blunders": blunders,
+            "good_openings": [{"opening": opening, "count": count}
+                              for opening, count in good_openings.most_common(self.top)],
+        }
+
+    # Run all jobs, returns their results in the order of jobs
+    def run_jobs(self, jobs):
+        jobs = [Job(*job) for job in jobs]
+        if not jobs:
+            return list()
+
+        with stage("batch_load_buckets"):
+            self.load_buckets(jobs)
+
+        results = [None] * len(jobs)
+        groups = self.group_jobs(jobs)
+        for group_index, ((keys, starting_moves), indexes) in enumerate(groups.items(), start=1):
+            cache_path = self.cache_path(keys, starting_moves)
+            scored = self.cached_results(cache_path)  # Key: color, Value: results
+            colors = {jobs[index].color for index in indexes}
+            if colors <= scored.keys():
+                print(f"Window {group_index}/{len(groups)}: unchanged, {len(indexes)} jobs")
+                for index in indexes:
+                    results[index] = {**jobs[index]._asdict(), **scored[jobs[index].color]}
+                continue
+
+            print(f"Window {group_index}/{len(groups)}: {len(keys)} buckets, {len(indexes)} jobs")
+            with stage("batch_merge_tree"):
+                opening_tree = self.opening_tree(keys, starting_moves)
+
+            # Don't consider rare positions, like extract_blunders_2.find_common_blunders
+            with stage("batch_evaluate"):
+                scorer = BlunderScorer(opening_tree, max(len(opening_tree) / 100000, 1))
+                scorer.set_evals(evaluate_nodes(opening_tree, scorer.eval_nodes(), self.eval_cache))
+
+            with stage("batch_score"):
+                for color in colors - scored.keys():
+                    scored[color] = self.analyse(scorer, color)
+            self.save_results(cache_path, scored)
+            for index in indexes:
+                results[index] = {**jobs[index]._asdict(), **scored[jobs[index].color]}
+        return results
+
+    def close(self):
+        self.eval_cache.close()
+        self.DB.close_connection()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Importable entry point: run (desired_elo, elo_buffer, color, starting_moves) jobs, returns a result per job
+def run_batch(jobs, time_controls=None, top=BATCH_TOP):
+    with BatchAnalysis(time_controls, top) as batch:
+        return batch.run_jobs(jobs)
+
+
+# Every combination of the given elos, buffers, colors and starting moves
+def sweep_jobs(elos, elo_buffers=(200,), colors=("none",), starting_moves=("none",)):
+    return [Job(elo, elo_buffer, color, moves)
+            for elo in elos for elo_buffer in elo_buffers for color in colors for moves in starting_moves]
+
+
+# Jobs from a CSV file with a header row or a JSON list of objects, using the Job field names
+def read_jobs(path):
+    with open(path, newline="") as f:
+        records = json.load(f) if path.endswith(".json") else list(csv.DictReader(f))
+    jobs = list()
+    for record in records:
+        job = Job(**{field: value for field, value in record.items() if field in Job._fields and value != ""})
+        jobs.append(job._replace(desired_elo=int(job.desired_elo), elo_buffer=int(job.elo_buffer)))
+    return jobs
+
+
+def write_json(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+# One row per job and blunder, jobs without blunders get a single row with the blunder columns empty
+def write_csv(path, results):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        for result in results:
+            job = {field: result[field] for field in (*Job._fields, "games")}
+            if not result["blunders"]:
+                writer.writerow(job)
+            for rank, blunder in enumerate(result["blunders"], start=1):
+                writer.writerow({**job, "rank": rank, **blunder,
+                                 "next_moves": json.dumps(blunder["next_moves"]),
+                                 "openings": "; ".join(blunder["openings"])})
+
+
+# Elos as a start:stop:step range (stop included) or a single value
+def parse_elos(values):
+    elos = list()
+    for value in values:
+        if ":" in value:
+            start, stop, step = (list(map(int, value.split(":"))) + [tree_store.BUCKET_SIZE])[:3]
+            elos.extend(range(start, stop + 1, step))
+        else:
+            elos.append(int(value))
+    return elos
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Find common blunders for many elo windows, colors and starting "
+                                                 "moves in one run")
+    parser.add_argument("--elo", nargs="+", default=["1500"],
+                        help="desired elos, values or start:stop:step ranges (e.g. 800:2400:100)")
+    parser.add_argument("--buffer", nargs="+", type=int, default=[200], help="elo buffers")
+    parser.add_argument("--color", nargs="+", default=["none"], choices=["white", "black", "none"])
+    parser.add_argument("--starting-moves", nargs="+", default=["none"],
+                        help='starting moves, one quoted string per job (e.g. "e4 e5")')
+    parser.add_argument("--jobs", metavar="FILE", help="CSV or JSON file of jobs, instead of the sweep arguments")
+    parser.add_argument("--time-controls", nargs="+", choices=tree_store.TIME_CONTROL_CLASSES,
+                        help="only use games of these time control classes")
+    parser.add_argument("--top", type=int, default=BATCH_TOP, help="blunders and good openings kept per job")
+    parser.add_argument("--output", default="batch_results.json", help="results file, .json or .csv")
+    args = parser.parse_args()
+
+    if args.jobs:
+        jobs = read_jobs(args.jobs)
+    else:
+        jobs = sweep_jobs(parse_elos(args.elo), args.buffer, args.color, args.starting_moves)
+
+    start_time = datetime.now()
+    results = run_batch(jobs, args.time_controls, args.top)
+    end_time = datetime.now()
+
+    if args.output.endswith(".csv"):
+        write_csv(args.output, results)
+    else:
+        write_json(args.output, results)
+    print(f"{len(jobs)} jobs written to {args.output}, runtime: {str(end_time - start_time)[:-3]}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime, timedelta
+
+# The benchmark always runs on the embedded backend in a scratch directory, never on configured databases
+# Set before the other modules are imported, they read their configuration on import
+os.environ.update({
+    "STORAGE_BACKEND": "duckdb",
+    "EMBEDDED_DB_PATH": "benchmark.duckdb",
+    "EVAL_CACHE_PATH": "fen_evaluations.sqlite",
+    "EVAL_MODE": "fixed",
+    "EVAL_SERVICE": "off",
+    # The fake engine is patched into this process, pool workers started with spawn wouldn't have it
+    "STOCKFISH_WORKERS": "1",
+    "TREE_DIR": "trees",
+    "PARQUET_DIR": "games_parquet",
+})
+
+import chess
+import metrics
+import stockfish_analysis
+import extract_blunders
+import extract_blunders_2
+from database import Db
+from games import GameDimensions
+from store_openings import store_opening_moves, insert_columns, max_moves
+
+RESULTS_DIR = "benchmark_results"
+TIME_CONTROLS = ("60+0", "180+0", "180+2", "300+0", "300+3", "600+0", "900+10", "1800+0")
+ID_CHARACTERS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+ROW_CHUNK = 100000
+
+
+# Deterministic stand-in for get_stockfish_eval, the eval is derived from a hash of the FEN
+# Cheap enough that the benchmark measures everything around the engine rather than the search
+def fake_stockfish_eval(fen):
+    return {"type": "cp", "value": zlib.crc32(fen.encode()) % 601 - 300}
+
+
+def use_fake_engine():
+    stockfish_analysis.create_engine = lambda threads=2: None
+    stockfish_analysis.get_stockfish_eval = fake_stockfish_eval
+
+
+# Distinct random games, moves are picked with Zipf weights so popular lines are shared by many games
+# like in real opening data. Returns a list of SAN move lists
+def generate_lines(count, seed, plies=max_moves, skew=1.2):
+    rng = random.Random(seed)
+    legal_moves = dict()  # Key: move prefix, Value: legal moves sorted by UCI
+    lines = set()
+    while len(lines) < count:
+        board = chess.Board()
+        line = list()
+        for _ in range(plies):
+            prefix = tuple(line)
+            if prefix not in legal_moves:
+                legal_moves[prefix] = sorted(board.legal_moves, key=chess.Move.uci)
+            moves = legal_moves[prefix]
+            if not moves:
+                break
+            move = rng.choices(moves, weights=[1 / (rank + 1) ** skew for rank in range(len(moves))])[0]
+            line.append(board.san(move))
+            board.push(move)
+        lines.add(tuple(line))
+    return sorted(lines)
+
+
+def game_id(index):
+    characters = list()
+    for _ in range(8):
+        index, digit = divmod(index, len(ID_CHARACTERS))
+        characters.append(ID_CHARACTERS[digit])
+    return "".join(characters)
+
+
+# Yield games drawn from the distinct lines, as (moves, white elo, black elo, opening, time control, game id)
+# The opening is named after the first moves, so games of the same line always get the same opening
+def synthetic_games(count, lines, seed):
+    rng = random.Random(seed)
+    for index in range(count):
+        moves = rng.choice(lines)
+        white_elo = min(max(int(rng.gauss(1500, 350)), 600), 3000)
+        black_elo = min(max(white_elo + int(rng.gauss(0, 100)), 600), 3000)
+        yield (moves, white_elo, black_elo, "Synthetic: " + " ".join(moves[:3]), rng.choice(TIME_CONTROLS),
+               game_id(index))
+
+
+def write_pgn(path, games):
+    with open(path, "w") as f:
+        for moves, white_elo, black_elo, opening, time_control, lichess_id in games:
+            movetext = " ".join(f"{index // 2 + 1}. {move}" if index % 2 == 0 else move
+                                for index, move in enumerate(moves))
+            f.write(f'[Event "Rated game"]\n[Site "https://lichess.org/{lichess_id}"]\n[Result "*"]\n'
+                    f'[WhiteElo "{white_elo}"]\n[BlackElo "{black_elo}"]\n[TimeControl "{time_control}"]\n'
+                    f'[Opening "{opening}"]\n\n{movetext} *\n\n')
+
+
+# Bulk load games straight into opening_moves as rows, skipping PGN parsing, for the larger scales
+def load_rows(games):
+    DB = Db()
+    dimensions = GameDimensions(DB)
+    rows = list()
+    for moves, white_elo, black_elo, opening, time_control, lichess_id in games:
+        rows.append((" ".join(moves), (white_elo + black_elo) / 2, opening, time_control, -1, lichess_id))
+        if len(rows) >= ROW_CHUNK:
+            DB.load_data("opening_moves", insert_columns, dimensions.encode(rows))
+            rows = list()
+    if rows:
+        DB.load_data("opening_moves", insert_columns, dimensions.encode(rows))
+    DB.close_connection()
+
+
+# Peak resident set size of this process in MB, from /proc where the peak can be reset between stages
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and bytes on macOS, and is the peak of the whole run
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# Run one stage, recording its latency, throughput and peak RSS in results
+# count(result) is the number of units (games, nodes, positions...) the stage processed
+# Stages are profiled like any other when they're listed in PROFILE_STAGES (see metrics)
+def run_stage(results, name, unit, count, function, *args, **kwargs):
+    reset_peak_rss()
+    start = time.perf_counter()
+    with metrics.stage(name):
+        result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    items = count(result)
+    results.append({
+        "stage": name,
+        "seconds": round(seconds, 4),
+        "items": items,
+        "unit": unit,
+        "per_second": round(items / seconds, 1) if seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    print(f"\n{name} runtime: {str(timedelta(seconds=seconds))[:-3]} ({items} {unit})\n")
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Generate the data, then run every stage of both analysis scripts over it
+def benchmark(games=10000, distinct_games=2000, seed=1, rows=False, desired_elo=1500, elo_buffer=200,
+              color="white"):
+    use_fake_engine()
+    results = list()
+
+    # Games are generated as they're loaded with rows, so generate_seconds only covers the PGN file otherwise
+    start = time.perf_counter()
+    lines = generate_lines(distinct_games, seed)
+    if not rows:
+        write_pgn("benchmark.pgn", synthetic_games(games, lines, seed))
+    generate_seconds = time.perf_counter() - start
+
+    if rows:
+        run_stage(results, "load_rows", "games", lambda result: games, load_rows,
+                  synthetic_games(games, lines, seed))
+    else:
+        with open("benchmark.pgn", "rb") as pgn:
+            run_stage(results, "store_opening_moves", "games", lambda result: games, store_opening_moves, pgn)
+
+    # Opening tree version (extract_blunders_2.py)
+    opening_tree = run_stage(results, "generate_opening_tree", "games", lambda tree: tree.count[0],
+                             extract_blunders_2.generate_opening_tree, desired_elo, elo_buffer)
+    blunder_dict, fen_dict = run_stage(results, "find_common_blunders (tree)", "nodes",
+                                       lambda result: len(opening_tree),
+                                       extract_blunders_2.find_common_blunders, opening_tree, color)
+    run_stage(results, "generate_good_openings (tree)", "blunders", lambda result: len(blunder_dict),
+              extract_blunders_2.generate_good_openings, blunder_dict)
+
+    # Common positions version (extract_blunders.py), evaluations are cleared so it evaluates its own positions
+    DB = Db()
+    DB.execute("DELETE FROM fen_evaluations")
+    DB.close_connection()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(os.environ["EVAL_CACHE_PATH"] + suffix):
+            os.remove(os.environ["EVAL_CACHE_PATH"] + suffix)
+    pos_dict, opening_dict, fen_dict = run_stage(results, "generate_common_positions", "positions",
+                                                 lambda result: len(result[0]),
+                                                 extract_blunders.generate_common_positions, desired_elo, elo_buffer)
+    blunder_eval_dict = run_stage(results, "find_common_blunders (positions)", "positions",
+                                  lambda result: len(pos_dict),
+                                  extract_blunders.find_common_blunders, pos_dict, fen_dict, color)
+    run_stage(results, "generate_good_openings (positions)", "blunders", lambda result: len(blunder_eval_dict),
+              extract_blunders.generate_good_openings, opening_dict, blunder_eval_dict)
+
+    return {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"games": games, "distinct_games": distinct_games, "seed": seed, "rows": rows,
+                   "desired_elo": desired_elo, "elo_buffer": elo_buffer, "color": color},
+        "generate_seconds": round(generate_seconds, 4),
+        "stages": results,
+        "metrics": metrics.snapshot(),
+    }
+
+
+# Print the stage latencies of a run next to those of an earlier one
+def compare(result, baseline):
+    baseline_stages = {stage["stage"]: stage for stage in baseline["stages"]}
+    print(f"{'stage':<36}{baseline['commit']:>12}{result['commit']:>12}{'change':>10}")
+    for stage in result["stages"]:
+        old = baseline_stages.get(stage["stage"])
+        if old is None or not old["seconds"]:
+            continue
+        change = stage["seconds"] / old["seconds"] - 1
+        print(f"{stage['stage']:<36}{old['seconds']:>11.3f}s{stage['seconds']:>11.3f}s{change:>+10.1%}")
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, tree building and blunder search "
+                                                 "on synthetic games with a fake engine")
+    parser.add_argument("--games", type=int, default=10000, help="number of games to generate")
+    parser.add_argument("--distinct-games", type=int, default=2000, help="number of distinct move sequences")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rows", action="store_true",
+                        help="bulk load opening_moves rows instead of storing a PGN file (for large scales)")
+    parser.add_argument("--elo", type=int, default=1500, help="desired elo of the analysis")
+    parser.add_argument("--elo-buffer", type=int, default=200)
+    parser.add_argument("--color", default="white", choices=["white", "black", "none"])
+    parser.add_argument("--output", help="results file (default: benchmark_results/<commit>-<games>.json)")
+    parser.add_argument("--compare", metavar="FILE", help="results file of an earlier run to compare against")
+    parser.add_argument("--workdir", help="directory for the generated data (default: a temporary directory)")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(RESULTS_DIR, f"{git_commit()}-{args.games}.json"))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chess_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        result = benchmark(args.games, args.distinct_games, args.seed, args.rows, args.elo, args.elo_buffer,
+                           args.color)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+    if baseline:
+        compare(result, baseline)
+
+
+if __name__ == "__main__":
+    run()
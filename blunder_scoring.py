@@ -0,0 +1,168 @@
+import collections
+import numpy as np
+from opening_tree import ChildrenView, NO_NODE
+
+
+# Vectorized blunder scoring over an OpeningTree
+# Everything that doesn't depend on the colour or thresholds (depths, sibling totals, which positions are
+# searched) is computed once, so re-scoring with other settings is a handful of NumPy passes
+class BlunderScorer:
+    def __init__(self, opening_tree, min_count=1, min_depth=9):
+        self.tree = opening_tree
+        self.parent = np.frombuffer(opening_tree.parent, dtype=np.int32).astype(np.int64)
+        self.count = np.frombuffer(opening_tree.count, dtype=np.uint32).astype(np.int64)
+        self.first_child = np.frombuffer(opening_tree.first_child, dtype=np.int32)
+        if opening_tree.key is not None:
+            self.key = np.frombuffer(opening_tree.key, dtype=np.int64)
+        else:
+            self.key = np.array([opening_tree.node_key(node) for node in range(len(opening_tree))], dtype=np.int64)
+        size = len(self.parent)
+
+        # Parents always come before their children, so depths can be filled in one level at a time
+        self.depth = np.zeros(size, dtype=np.int64)
+        for _ in range(size):
+            depth = self.depth.copy()
+            depth[1:] = self.depth[self.parent[1:]] + 1
+            if np.array_equal(depth, self.depth):
+                break
+            self.depth = depth
+        order = np.argsort(self.depth, kind="stable")
+        bounds = np.searchsorted(self.depth[order], np.arange(self.depth.max() + 2))
+        self.levels = [order[bounds[level]:bounds[level + 1]] for level in range(1, len(bounds) - 1)]
+
+        # Total number of moves played from each node's parent position
+        child_total = np.bincount(self.parent[1:], weights=self.count[1:], minlength=size)
+        self.sibling_total = child_total[np.maximum(self.parent, 0)]
+
+        # The search only continues through positions with following moves that aren't rare
+        eligible = (self.first_child != NO_NODE) & (self.count > min_count)
+        reachable = np.zeros(size, dtype=bool)
+        reachable[0] = True
+        for level in self.levels:
+            reachable[level] = eligible[level] & reachable[self.parent[level]]
+
+        # Don't calculate blunder probability until move 5
+        self.is_search_node = reachable & (self.depth >= min_depth)
+        self.search_nodes = np.flatnonzero(self.is_search_node)
+        self.is_search_child = np.zeros(size, dtype=bool)
+        self.is_search_child[1:] = self.is_search_node[self.parent[1:]]
+
+        self.evals = np.full(size, np.nan)
+
+    # Nodes whose evaluation is needed: the searched positions and the positions following them
+    def eval_nodes(self):
+        return np.flatnonzero(self.is_search_node | self.is_search_child)
+
+    # Fill in node evaluations from a dict of position key -> eval
+    # Positions without an evaluation (still queued in the evaluation service) stay NaN and never count as blunders
+    def set_evals(self, evals):
+        for node in self.eval_nodes():
+            self.evals[node] = evals.get(int(self.key[node]), np.nan)
+
+    # Chance of reaching every node, if playing white the probability of all white moves is 100% (and vice versa)
+    def reach_probabilities(self, color="none"):
+        pos_prob = np.ones(len(self.parent))
+        for depth, level in enumerate(self.levels, start=1):
+            if (color == "white" and depth % 2 == 0) or (color == "black" and depth % 2 == 1) or (color == "none"):
+                pos_prob[level] = pos_prob[self.parent[level]] * self.count[level] / self.sibling_total[level]
+            else:
+                pos_prob[level] = pos_prob[self.parent[level]]
+        return pos_prob
+
+    # Score all searched positions, returns arrays ordered by blunder probability descending
+    # A following move is a blunder if it gains eval_buffer for the player and leaves white >= white_min_eval
+    # (or black with an eval <= black_max_eval). Transpositions are combined by position key
+    def score(self, color="none", eval_buffer=0.5, white_min_eval=0.5, black_max_eval=0, min_blunder_prob=0.5):
+        pos_prob = self.reach_probabilities(color)
+
+        children = np.flatnonzero(self.is_search_child)
+        next_eval = self.evals[children]
+        curr_eval = self.evals[self.parent[children]]
+        blunder = np.zeros(len(children), dtype=bool)
+        if color in ("white", "none"):
+            blunder |= (next_eval - curr_eval >= eval_buffer) & (next_eval >= white_min_eval)
+        if color in ("black", "none"):
+            blunder |= (curr_eval - next_eval >= eval_buffer) & (next_eval <= black_max_eval)
+        blunder_count = np.bincount(self.parent[children][blunder], weights=self.count[children][blunder],
+                                    minlength=len(self.parent))
+
+        # Combine positions reached through different move orders
+        nodes = self.search_nodes
+        keys, first, group = np.unique(self.key[nodes], return_index=True, return_inverse=True)
+        comb_pos_prob = np.bincount(group, weights=pos_prob[nodes], minlength=len(keys))
+        comb_blunder_count = np.bincount(group, weights=blunder_count[nodes], minlength=len(keys)).astype(np.int64)
+        comb_count = np.bincount(group, weights=self.count[nodes], minlength=len(keys)).astype(np.int64)
+
+        # Only keep positions with a high enough chance of a blunder, most likely first
+        blunder_prob = comb_blunder_count / comb_count
+        keep = np.flatnonzero(blunder_prob > min_blunder_prob)
+        keep = keep[np.argsort(-blunder_prob[keep], kind="stable")]
+
+        return {
+            "key": keys[keep],
+            "node": nodes[first[keep]],
+            "pos_prob": comb_pos_prob[keep],
+            "blunder_count": comb_blunder_count[keep],
+            "count": comb_count[keep],
+            "blunder_prob": blunder_prob[keep],
+        }
+
+    # Turn score() results into the blunder_dict and fen_dict used for display
+    # blunder_dict: Key: position keys, Value: (chance of reaching this position, number of following blunders,
+    # number of position occurrences, next moves, openings)
+    # With fen_limit, only the FENs of the first fen_limit blunders are worked out
+    def blunder_dict(self, scores, fen_limit=None):
+        next_moves, openings = dict(), dict()
+        for node in self.search_nodes[np.isin(self.key[self.search_nodes], scores["key"])].tolist():
+            key = int(self.key[node])
+            next_moves.setdefault(key, collections.Counter()).update(
+                {move: tn.count for move, tn in ChildrenView(self.tree, node).items()})
+            openings.setdefault(key, set()).update(self.tree.node_openings(node))
+
+        blunder_dict, fen_dict = dict(), dict()
+        for index, (key, node, pos_prob, blunder_count, count) in enumerate(zip(
+                scores["key"].tolist(), scores["node"].tolist(), scores["pos_prob"].tolist(),
+                scores["blunder_count"].tolist(), scores["count"].tolist())):
+            # Sort next moves by number of occurrences descending
+            moves = dict(next_moves[key].most_common())
+            blunder_dict[key] = (pos_prob, blunder_count, count, moves, list(openings[key]))
+            if fen_limit is None or index < fen_limit:
+                fen_dict[key] = self.tree.fen(node)
+        return blunder_dict, fen_dict
+
+
+# Vectorized version of the position averaging in extract_blunders.find_common_blunders
+# pos_dict: Key: positions, Value: list of all played following positions, evals: Key: positions, Value: eval
+# Returns Key: positions followed by a blunder, Value: (current eval, average eval of following positions),
+# sorted from largest blunders to smallest blunders
+def average_blunders(pos_dict, evals, color="none", eval_buffer=0.5, min_next_eval=1):
+    positions = list(pos_dict)
+    if not positions:
+        return dict()
+
+    # Flatten the following positions so every average is one segment sum
+    lengths = np.fromiter((len(pos_dict[pos]) for pos in positions), dtype=np.int64, count=len(positions))
+    next_evals = np.fromiter((evals[next_pos] for pos in positions for next_pos in pos_dict[pos]),
+                             dtype=np.float64, count=int(lengths.sum()))
+    curr_evals = np.fromiter((evals[pos] for pos in positions), dtype=np.float64, count=len(positions))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+    # Evals are whole centipawns, so sum them exactly as integers instead of accumulating float error
+    # Rounding goes through Python's round, which unlike np.round is correctly rounded
+    sum_next_evals = np.add.reduceat(np.rint(next_evals * 100).astype(np.int64), offsets) / 100
+    avg_next_evals = np.array([round(avg, 2) for avg in (sum_next_evals / lengths).tolist()])
+
+    # Keep positions where the average next eval gains eval_buffer and is over +/-min_next_eval for the desired color
+    keep = avg_next_evals - curr_evals >= eval_buffer
+    if color == "none":
+        keep &= np.abs(avg_next_evals) >= min_next_eval
+    elif color == "white":
+        keep &= avg_next_evals >= min_next_eval
+    elif color == "black":
+        keep &= avg_next_evals <= -1 * min_next_eval
+    else:
+        keep[:] = False
+
+    keep = np.flatnonzero(keep)
+    keep = keep[np.argsort(-np.abs(avg_next_evals[keep] - curr_evals[keep]), kind="stable")]
+    return {positions[index]: (curr_evals[index].item(), avg_next_evals[index].item()) for index in keep.tolist()}
@@ -1,24 +1,65 @@
-from mysql import connector
-from mysql.connector import errorcode
 import os
+import re
+import csv
+import tempfile
+from metrics import ROWS_INSERTED
 
-class Db:
+try:
+    from mysql import connector
+    from mysql.connector import errorcode
+except ImportError:
+    connector = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Bulk insert configuration, overridable through environment variables
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 5000))
+DB_COMMIT_INTERVAL = int(os.getenv("DB_COMMIT_INTERVAL", 10))
+DB_STREAM_CHUNK = int(os.getenv("DB_STREAM_CHUNK", 10000))
+
+# "mysql" for the MySQL server configured by DB_HOST/DB_USER/DB_PASS/CHESS_DB_NAME, "duckdb" for an embedded
+# database file at EMBEDDED_DB_PATH, for single node runs without a server
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mysql")
+EMBEDDED_DB_PATH = os.getenv("EMBEDDED_DB_PATH", "chess_analysis.duckdb")
+
+
+def get_db_config():
+    # Code from https://stackoverflow.com/questions/58633300/how-to-create-a-dictionary-from-os-environment-variables
+    config = {
+        'host':'DB_HOST',
+        'user':'DB_USER',
+        'password':'DB_PASS',
+        'database':'CHESS_DB_NAME'
+    }
+    db_config = {k: os.getenv(v) for k,v in config.items()
+     if v in os.environ}
+    db_config.setdefault('database', 'chess_analysis')
+    # Needed for LOAD DATA LOCAL INFILE
+    db_config['allow_local_infile'] = True
+    return db_config
+
+
+# Connect to the configured storage backend
+# Queries are written for MySQL, the embedded backend translates the few dialect differences (see translate_query)
+def Db():
+    if STORAGE_BACKEND == "duckdb":
+        return DuckDb()
+    return MySqlDb()
+
+
+class MySqlDb:
     def __init__(self):
         # Connect to db, inspired by https://github.com/CatCookie/DomainSearch/blob/master/src/additional/database.py
         # and https://dev.mysql.com/doc/connector-python/en/connector-python-example-connecting.html
+        if connector is None:
+            raise ImportError("mysql-connector-python is required for STORAGE_BACKEND=mysql "
+                              "(pip install mysql-connector-python)")
 
         try:
-            # Code from https://stackoverflow.com/questions/58633300/how-to-create-a-dictionary-from-os-environment-variables
-            config = {
-                'host':'DB_HOST',
-                'user':'DB_USER',
-                'password':'DB_PASS',
-                'database':'CHESS_DB_NAME'
-            }
-            db_config = {k: os.getenv(v) for k,v in config.items()
-             if v in os.environ}
-
-            self._cnx = connector.connect(**db_config)
+            self._cnx = connector.connect(**get_db_config())
             self.cursor = self._cnx.cursor(buffered=True, dictionary=True)
         except connector.Error as err:
             if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
@@ -27,21 +68,312 @@ class Db:
                 print("Database does not exist")
             else:
                 print(err)
-                
+
             self._cnx.close()
 
-    def execute(self, query, arguments = None):
+    def execute(self, query, arguments = None, commit=True):
         results = []
         for result in self.cursor.execute(query, arguments, multi=True):
             if result.with_rows:
                 results.append(result.fetchall())
-                
-        self._cnx.commit()
+
+        if commit:
+            self._cnx.commit()
         return results[0] if results else None
 
+    # Run an INSERT/UPDATE for many rows, batch_size rows per round trip and one commit at the end
+    def executemany(self, query, seq_of_arguments, batch_size=DB_BATCH_SIZE, commit=True):
+        batch = list()
+        for arguments in seq_of_arguments:
+            batch.append(arguments)
+            if len(batch) >= batch_size:
+                self.cursor.executemany(query, batch)
+                batch = list()
+        if batch:
+            self.cursor.executemany(query, batch)
+
+        if commit:
+            self._cnx.commit()
+
+    def commit(self):
+        self._cnx.commit()
+
+    def bulk_inserter(self, query, batch_size=DB_BATCH_SIZE, commit_interval=DB_COMMIT_INTERVAL):
+        return BulkInserter(self, query, batch_size, commit_interval)
+
+    # Load rows with LOAD DATA LOCAL INFILE, the fastest way to get large batches into MySQL
+    # The server needs local_infile enabled
+    def load_data(self, table, columns, rows, commit=True):
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", newline="", encoding="utf-8", delete=False) as f:
+            writer = csv.writer(f, delimiter="\t", quotechar='"', lineterminator="\n")
+            row_count = 0
+            for row in rows:
+                # With an empty ESCAPED BY, an unquoted NULL is read as SQL NULL
+                writer.writerow(["NULL" if value is None else value for value in row])
+                row_count += 1
+            path = f.name
+
+        try:
+            self.cursor.execute(
+                f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 "
+                f"FIELDS TERMINATED BY '\\t' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' LINES TERMINATED BY '\\n' "
+                f"({', '.join(columns)})", (path,))
+            if commit:
+                self._cnx.commit()
+            ROWS_INSERTED.inc(row_count, table=table)
+        finally:
+            os.remove(path)
+
+    # Stream the results of a large SELECT as tuples, fetched chunk_size rows at a time with an unbuffered cursor
+    # The generator has to be consumed (or closed) before running another query on this connection
+    def stream(self, query, arguments=None, chunk_size=DB_STREAM_CHUNK):
+        cursor = self._cnx.cursor(buffered=False)
+        try:
+            cursor.execute(query, arguments)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # Drain anything left so the connection can be reused
+            if cursor.with_rows:
+                cursor.fetchall()
+            cursor.close()
+
     def close_connection(self):
         self._cnx.close()
         self.cursor.close()
 
     def get_cursor(self):
         return self.cursor
+
+
+# MySQL-only syntax used by the queries, and what DuckDB uses instead
+dialect_rules = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\bINSERT IGNORE\b"), "INSERT OR IGNORE"),
+    (re.compile(r"\bLIKE\b"), "ILIKE"),
+    (re.compile(r"\bON DUPLICATE KEY UPDATE\b"), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"\bVALUES\((\w+)\)"), r"excluded.\1"),
+]
+
+
+def translate_query(query):
+    for pattern, replacement in dialect_rules:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+# Tables of the embedded database, the same layout migrations/003 gives the MySQL tables
+# No secondary indexes besides the game ID one that deduplicates games: DuckDB scans columns with zone maps,
+# and indexes would only slow down bulk loads
+EMBEDDED_SCHEMA = """
+CREATE SEQUENCE IF NOT EXISTS openings_id;
+CREATE SEQUENCE IF NOT EXISTS time_controls_id;
+CREATE TABLE IF NOT EXISTS openings (id INTEGER PRIMARY KEY DEFAULT nextval('openings_id'), name VARCHAR NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS time_controls (id INTEGER PRIMARY KEY DEFAULT nextval('time_controls_id'),
+                                          name VARCHAR NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS opening_moves (moves VARCHAR NOT NULL, elo DECIMAL(5, 1) NOT NULL,
+                                          opening_id INTEGER NOT NULL, time_control_id SMALLINT NOT NULL,
+                                          pgn_id INTEGER NOT NULL DEFAULT -1, game_id VARCHAR);
+ALTER TABLE opening_moves ADD COLUMN IF NOT EXISTS game_id VARCHAR;
+CREATE UNIQUE INDEX IF NOT EXISTS opening_moves_game_id ON opening_moves (game_id);
+CREATE TABLE IF NOT EXISTS fen_evaluations (pos_key BIGINT PRIMARY KEY, fen VARCHAR NOT NULL,
+                                            evaluation DECIMAL(5, 2) NOT NULL, depth SMALLINT);
+"""
+
+# Column identifying the rows of each embedded table. Inserts skip rows whose key is already stored with an
+# anti-join instead of relying on the unique indexes, which can miss rows replayed from the WAL after a crash
+UNIQUE_COLUMNS = {"opening_moves": "game_id", "fen_evaluations": "pos_key", "openings": "name", "time_controls": "name"}
+
+insert_ignore_re = re.compile(r"^\s*INSERT OR IGNORE INTO (\w+) \(([^)]*)\) VALUES \([?, ]*\)\s*$")
+upsert_re = re.compile(r"^\s*INSERT INTO (\w+) \(([^)]*)\) VALUES \([?, ]*\) ON CONFLICT DO UPDATE SET (.+?)\s*$",
+                       re.DOTALL)
+
+
+# Embedded DuckDB backend with the same interface as MySqlDb
+# A DuckDB file can only be opened for writing by one process at a time
+class DuckDb:
+    def __init__(self, path=EMBEDDED_DB_PATH):
+        if duckdb is None:
+            raise ImportError("duckdb is required for STORAGE_BACKEND=duckdb (pip install duckdb)")
+        self._cnx = duckdb.connect(path)
+        self._cnx.execute(EMBEDDED_SCHEMA)
+        self.cursor = self._cnx
+        self._column_types = dict()
+
+    # Rows are returned as dicts like MySqlDb's dictionary cursor
+    # Every statement is committed straight away, see commit
+    def execute(self, query, arguments=None, commit=True):
+        result = self._cnx.execute(translate_query(query), arguments or [])
+        if result.description is None:
+            return None
+        columns = [column[0] for column in result.description]
+        return [dict(zip(columns, row)) for row in result.fetchall()]
+
+    # INSERT IGNOREs and upserts of whole rows are bulk loaded like load_data, DuckDB runs a prepared statement
+    # per row otherwise, at a few hundred rows a second
+    def executemany(self, query, seq_of_arguments, batch_size=DB_BATCH_SIZE, commit=True):
+        query = translate_query(query)
+        match = insert_ignore_re.match(query)
+        if match:
+            self._load_rows(match.group(1), [column.strip() for column in match.group(2).split(",")],
+                            seq_of_arguments)
+            return
+        match = upsert_re.match(query)
+        if match:
+            self._upsert_rows(match.group(1), [column.strip() for column in match.group(2).split(",")],
+                              seq_of_arguments, match.group(3))
+            return
+
+        batch = list()
+        for arguments in seq_of_arguments:
+            batch.append(arguments)
+            if len(batch) >= batch_size:
+                self._cnx.executemany(query, batch)
+                batch = list()
+        if batch:
+            self._cnx.executemany(query, batch)
+
+    # Statements are already committed, but their changes may only be in the WAL. Checkpoint them into the database
+    # file, so work recorded as done after a commit (e.g. ingest progress) is never replayed from the WAL
+    def commit(self):
+        self._cnx.execute("CHECKPOINT")
+
+    def bulk_inserter(self, query, batch_size=DB_BATCH_SIZE, commit_interval=DB_COMMIT_INTERVAL):
+        return BulkInserter(self, query, batch_size, commit_interval)
+
+    # Column name -> type of a table, for reading staged rows with the table's types
+    def column_types(self, table):
+        if table not in self._column_types:
+            self._column_types[table] = {row[0]: row[1] for row in self._cnx.execute(
+                "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = ?",
+                [table]).fetchall()}
+        return self._column_types[table]
+
+    # Write rows to a temporary CSV file, returns (path, row count)
+    # Rows repeating a key are dropped, the first one is kept, or the last one with keep_last
+    def _stage_rows(self, columns, rows, key, keep_last=False):
+        key_index = columns.index(key) if key in columns else None
+        if keep_last and key_index is not None:
+            rows = {row[key_index]: row for row in rows}.values()
+        seen = set()
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", encoding="utf-8", delete=False) as f:
+            writer = csv.writer(f, lineterminator="\n")
+            row_count = 0
+            for row in rows:
+                if key_index is not None and row[key_index] is not None:
+                    if row[key_index] in seen:
+                        continue
+                    seen.add(row[key_index])
+                writer.writerow(["NULL" if value is None else value for value in row])
+                row_count += 1
+        return f.name, row_count
+
+    # Staged rows read by DuckDB's vectorized CSV reader with the table's column types, takes the path as argument
+    def _staged_rows_query(self, table, columns):
+        types = self.column_types(table)
+        return ("SELECT * FROM read_csv(?, header = false, nullstr = 'NULL', columns = {" +
+                ", ".join(f"'{column}': '{types[column]}'" for column in columns) + "})")
+
+    # Rows whose UNIQUE_COLUMNS key is already stored, or repeated in rows, are skipped like LOAD DATA LOCAL
+    # does in MySQL. Returns the number of rows staged
+    def _load_rows(self, table, columns, rows):
+        key = UNIQUE_COLUMNS.get(table)
+        path, row_count = self._stage_rows(columns, rows, key)
+        try:
+            query = f"INSERT INTO {table} ({', '.join(columns)}) SELECT * FROM ({self._staged_rows_query(table, columns)}) AS new"
+            if key in columns:
+                query += f" WHERE new.{key} IS NULL OR new.{key} NOT IN (SELECT {key} FROM {table} WHERE {key} IS NOT NULL)"
+            self._cnx.execute(query, [path])
+        finally:
+            os.remove(path)
+        return row_count
+
+    # Rows whose UNIQUE_COLUMNS key is already stored get the assignments (a SET clause using excluded.column for
+    # the new values), the others are inserted. The last row of a key wins, like running the upserts in order
+    # Keys are matched with joins instead of the unique indexes, like _load_rows
+    def _upsert_rows(self, table, columns, rows, assignments):
+        key = UNIQUE_COLUMNS[table]
+        path, row_count = self._stage_rows(columns, rows, key, keep_last=True)
+        try:
+            self._cnx.execute("BEGIN TRANSACTION")
+            self._cnx.execute(f"CREATE TEMP TABLE excluded AS {self._staged_rows_query(table, columns)}", [path])
+            self._cnx.execute(f"UPDATE {table} SET {assignments} FROM excluded WHERE {table}.{key} = excluded.{key}")
+            self._cnx.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT * FROM excluded "
+                              f"WHERE excluded.{key} NOT IN (SELECT {key} FROM {table})")
+            self._cnx.execute("DROP TABLE excluded")
+            self._cnx.execute("COMMIT")
+        except BaseException:
+            self._cnx.execute("ROLLBACK")
+            raise
+        finally:
+            os.remove(path)
+        return row_count
+
+    # Bulk load through a temporary CSV file read by DuckDB's vectorized CSV reader
+    def load_data(self, table, columns, rows, commit=True):
+        ROWS_INSERTED.inc(self._load_rows(table, columns, rows), table=table)
+
+    # Stream the results of a large SELECT as tuples, chunk_size rows at a time
+    # Runs on its own cursor, so other queries can run while the generator is being consumed
+    def stream(self, query, arguments=None, chunk_size=DB_STREAM_CHUNK):
+        cursor = self._cnx.cursor()
+        try:
+            cursor.execute(translate_query(query), arguments or [])
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def close_connection(self):
+        self._cnx.close()
+
+    def get_cursor(self):
+        return self.cursor
+
+
+insert_table_re = re.compile(r"\bINTO\s+(\w+)", re.IGNORECASE)
+
+
+# Buffers rows and inserts them batch_size at a time, committing every commit_interval batches
+class BulkInserter:
+    def __init__(self, DB, query, batch_size=DB_BATCH_SIZE, commit_interval=DB_COMMIT_INTERVAL):
+        self.DB = DB
+        self.query = query
+        self.table = insert_table_re.search(query).group(1)
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.rows = list()
+        self.batches = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self, commit=False):
+        if self.rows:
+            self.DB.executemany(self.query, self.rows, batch_size=self.batch_size, commit=False)
+            ROWS_INSERTED.inc(len(self.rows), table=self.table)
+            self.rows = list()
+            self.batches += 1
+        if commit or self.batches % self.commit_interval == 0:
+            self.DB.commit()
+
+    def close(self):
+        self.flush(commit=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from metrics import EVAL_LOOKUPS
+
+# Cache configuration, overridable through environment variables
+EVAL_CACHE_SIZE = int(os.getenv("EVAL_CACHE_SIZE", 1000000))
+EVAL_CACHE_PATH = os.getenv("EVAL_CACHE_PATH", "fen_evaluations.sqlite")
+EVAL_WRITE_BATCH = int(os.getenv("EVAL_WRITE_BATCH", 1000))
+# Evaluations searched shallower than this are treated as missing, so they get evaluated again and upgraded
+EVAL_MIN_DEPTH = int(os.getenv("EVAL_MIN_DEPTH", 0))
+
+# Max number of keys per SELECT ... IN (...) query
+LOOKUP_BATCH = 1000
+
+
+# NULL depths are from before depths were stored, when every position was searched to full depth
+def is_deeper(depth, other):
+    return other is not None and (depth is None or depth > other)
+
+
+# Three-level evaluation cache: in-memory LRU, local SQLite store, then the fen_evaluations table in MySQL
+# Positions are identified by their Zobrist key (see positions.position_key)
+# New evaluations are written to SQLite straight away and sent to MySQL in batches
+# Every evaluation is stored with the search depth it reached, rows from before depths were stored (NULL depth)
+# were all searched to full depth and always count as deep enough
+class EvalCache:
+    def __init__(self, DB=None, size=EVAL_CACHE_SIZE, path=EVAL_CACHE_PATH, write_batch=EVAL_WRITE_BATCH):
+        self.DB = DB
+        self.size = size
+        self.write_batch = write_batch
+        self._lru = OrderedDict()
+        self._pending = []
+
+        self._local = sqlite3.connect(path, timeout=30)
+        # WAL so the evaluation service can write while analysis scripts read (see eval_service)
+        self._local.execute("PRAGMA journal_mode=WAL")
+        self._local.execute("CREATE TABLE IF NOT EXISTS evaluations (pos_key INTEGER PRIMARY KEY, evaluation REAL, "
+                            "depth INTEGER)")
+        if "depth" not in [column[1] for column in self._local.execute("PRAGMA table_info(evaluations)")]:
+            self._local.execute("ALTER TABLE evaluations ADD COLUMN depth INTEGER")
+
+    def _remember(self, key, eval, depth):
+        self._lru[key] = (eval, depth)
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def get(self, key, min_depth=EVAL_MIN_DEPTH):
+        return self.get_many([key], min_depth).get(key)
+
+    # Look up many positions at once, returns a dict of the ones that have a stored evaluation of at least min_depth
+    def get_many(self, keys, min_depth=EVAL_MIN_DEPTH):
+        keys = dict.fromkeys(keys)
+        found = dict()  # Key: position keys, Value: (eval, depth)
+        missing = list()
+        for key in keys:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                found[key] = self._lru[key]
+            else:
+                missing.append(key)
+        lru_hits = len(found)
+        EVAL_LOOKUPS.inc(lru_hits, result="lru")
+
+        # Check the local store
+        for i in range(0, len(missing), LOOKUP_BATCH):
+            chunk = missing[i:i + LOOKUP_BATCH]
+            rows = self._local.execute(
+                f"SELECT pos_key, evaluation, depth FROM evaluations WHERE pos_key IN ({','.join('?' * len(chunk))})",
+                chunk)
+            found.update((key, (eval, depth)) for key, eval, depth in rows)
+        EVAL_LOOKUPS.inc(len(found) - lru_hits, result="local")
+        missing = [key for key in missing if key not in found]
+
+        # Fall back to MySQL and copy anything found there into the local store
+        # Before migrations/003 upgraded positions had a row per evaluation, the deepest one is used
+        if self.DB and missing:
+            from_db = dict()
+            for i in range(0, len(missing), LOOKUP_BATCH):
+                chunk = missing[i:i + LOOKUP_BATCH]
+                rows = self.DB.execute(
+                    f"SELECT pos_key, evaluation, depth FROM fen_evaluations WHERE pos_key IN ({', '.join(['%s'] * len(chunk))})", tuple(chunk))
+                for row in rows or []:
+                    if row["pos_key"] not in from_db or is_deeper(row["depth"], from_db[row["pos_key"]][1]):
+                        from_db[row["pos_key"]] = (float(row["evaluation"]), row["depth"])
+            found.update(from_db)
+            EVAL_LOOKUPS.inc(len(from_db), result="db")
+            self._local.executemany("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?)",
+                                    [(key, eval, depth) for key, (eval, depth) in from_db.items()])
+            self._local.commit()
+
+        EVAL_LOOKUPS.inc(len(keys) - len(found), result="miss")
+
+        for key, (eval, depth) in found.items():
+            if key not in self._lru:
+                self._remember(key, eval, depth)
+        return {key: eval for key, (eval, depth) in found.items() if depth is None or depth >= min_depth}
+
+    # Store a new evaluation, MySQL is only written once a full batch is pending
+    def put(self, key, eval, fen, depth=None):
+        self._remember(key, eval, depth)
+        self._local.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?)", (key, eval, depth))
+        self._pending.append((key, fen, eval, depth))
+        if len(self._pending) >= self.write_batch:
+            self.flush()
+
+    def flush(self):
+        self._local.commit()
+        if self.DB and self._pending:
+            # Positions are only evaluated again to upgrade a shallower evaluation, so the new one replaces it
+            self.DB.executemany("INSERT INTO fen_evaluations (pos_key, fen, evaluation, depth) VALUES (%s, %s, %s, %s) "
+                                "ON DUPLICATE KEY UPDATE evaluation = VALUES(evaluation), depth = VALUES(depth)",
+                                self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._local.close()
@@ -0,0 +1,178 @@
+import os
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+from database import Db
+from eval_cache import EvalCache
+from blunder_scoring import BlunderScorer
+from stockfish_analysis import STOCKFISH_WORKERS, EnginePool, eval_to_pawns
+
+# Service configuration, overridable through environment variables
+EVAL_QUEUE_PATH = os.getenv("EVAL_QUEUE_PATH", "eval_queue.sqlite")
+EVAL_SERVICE_BATCH = int(os.getenv("EVAL_SERVICE_BATCH", 256))
+EVAL_CHECKPOINT = int(os.getenv("EVAL_CHECKPOINT", 50))
+EVAL_POLL_INTERVAL = float(os.getenv("EVAL_POLL_INTERVAL", 2))
+
+# How analysis scripts get missing evaluations: "off" runs the engines themselves, "wait" queues the positions for
+# the service and waits for them, "partial" queues them and carries on with the evaluations already available
+EVAL_SERVICE = os.getenv("EVAL_SERVICE", "off")
+
+# Priorities, positions analysis scripts are waiting for go before pre-warming
+PRIORITY_PREWARM = 0
+PRIORITY_REQUEST = 10
+
+
+# Persistent queue of positions to evaluate, shared by the service and its clients through a SQLite file
+# Positions are keyed by their Zobrist key, so enqueueing a position that's already queued does nothing
+class EvalQueue:
+    def __init__(self, path=EVAL_QUEUE_PATH):
+        # WAL lets clients enqueue and poll while the service is writing
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (pos_key INTEGER PRIMARY KEY, fen TEXT NOT NULL, "
+                         "priority INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'pending', enqueued REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority, enqueued)")
+
+    # positions: {position key: fen}, an already queued position is only raised to the higher priority
+    def enqueue(self, positions, priority=PRIORITY_REQUEST):
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        self._db.executemany("INSERT INTO jobs (pos_key, fen, priority, enqueued) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (pos_key) DO UPDATE SET priority = MAX(priority, excluded.priority)",
+                             [(key, fen, priority, now) for key, fen in positions.items()])
+        self._db.execute("COMMIT")
+
+    # Take up to limit pending positions, highest priority and oldest first, returns [(position key, fen)]
+    def claim(self, limit=EVAL_SERVICE_BATCH):
+        self._db.execute("BEGIN IMMEDIATE")
+        jobs = self._db.execute("SELECT pos_key, fen FROM jobs WHERE status = 'pending' "
+                                "ORDER BY priority DESC, enqueued LIMIT ?", (limit,)).fetchall()
+        self._db.executemany("UPDATE jobs SET status = 'running' WHERE pos_key = ?", [(key,) for key, fen in jobs])
+        self._db.execute("COMMIT")
+        return jobs
+
+    # Evaluated positions leave the queue, their results live in the evaluation cache
+    def complete(self, keys):
+        self._db.executemany("DELETE FROM jobs WHERE pos_key = ?", [(key,) for key in keys])
+
+    # Positions claimed by a service that stopped before finishing them go back to pending
+    def release_running(self):
+        self._db.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    def pending_count(self):
+        return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+# Evaluation service main loop: claim queued positions, evaluate them across the engine pool and write the
+# results to the evaluation cache, committing every checkpoint positions so little work is lost on a crash
+# Runs until interrupted, or until the queue is empty with exit_when_empty
+def serve(workers=STOCKFISH_WORKERS, batch=EVAL_SERVICE_BATCH, checkpoint=EVAL_CHECKPOINT,
+          poll_interval=EVAL_POLL_INTERVAL, exit_when_empty=False):
+    DB = Db()
+    eval_cache = EvalCache(DB, write_batch=checkpoint)
+    eval_queue = EvalQueue()
+    engine_pool = EnginePool(workers)
+
+    eval_queue.release_running()
+    evaluated = 0
+    try:
+        while True:
+            jobs = eval_queue.claim(batch)
+            if not jobs:
+                if exit_when_empty:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            # Another run may have evaluated some of these since they were queued
+            stored = eval_cache.get_many(key for key, fen in jobs)
+            eval_queue.complete(stored)
+            keys = {fen: key for key, fen in jobs if key not in stored}
+
+            done = list()
+            for fen, eval, depth in engine_pool.evaluate_many(keys):
+                eval_cache.put(keys[fen], eval_to_pawns(eval), fen, depth)
+                done.append(keys[fen])
+                if len(done) >= checkpoint:
+                    eval_cache.flush()
+                    eval_queue.complete(done)
+                    evaluated += len(done)
+                    done = list()
+            eval_cache.flush()
+            eval_queue.complete(done)
+            evaluated += len(done)
+            print(f"\r{evaluated} positions evaluated, {eval_queue.pending_count()} queued", end="")
+    finally:
+        print()
+        eval_cache.close()
+        eval_queue.release_running()
+        eval_queue.close()
+        engine_pool.close()
+        DB.close_connection()
+    return evaluated
+
+
+# Client side: queue the positions that aren't in the evaluation cache yet
+# positions: {position key: fen}, returns the evaluations that are already stored, as position key -> eval
+def request_evaluations(eval_cache, positions, priority=PRIORITY_REQUEST):
+    evals = eval_cache.get_many(positions)
+    missing = {key: fen for key, fen in positions.items() if key not in evals}
+    if missing:
+        eval_queue = EvalQueue()
+        eval_queue.enqueue(missing, priority)
+        eval_queue.close()
+    return evals
+
+
+# Client side: poll the evaluation cache until every position has been evaluated by the service
+# callback(done count) is called after every poll, returns position key -> eval
+def wait_for_evaluations(eval_cache, keys, poll_interval=EVAL_POLL_INTERVAL, callback=None):
+    keys = list(dict.fromkeys(keys))
+    evals = eval_cache.get_many(keys)
+    while len(evals) < len(keys):
+        if callback:
+            callback(len(evals))
+        time.sleep(poll_interval)
+        evals.update(eval_cache.get_many([key for key in keys if key not in evals]))
+    if callback:
+        callback(len(evals))
+    return evals
+
+
+# Queue the common positions of an opening tree that have no evaluation yet, used to pre-warm the cache
+# after ingesting new games. Returns the number of positions queued
+def prewarm(opening_tree, eval_cache, min_count, priority=PRIORITY_PREWARM):
+    positions = dict()
+    for node in BlunderScorer(opening_tree, min_count).eval_nodes().tolist():
+        positions.setdefault(opening_tree.node_key(node), node)
+    stored = eval_cache.get_many(positions)
+    missing = {key: node for key, node in positions.items() if key not in stored}
+    request_evaluations(eval_cache, {key: opening_tree.fen(node) for key, node in missing.items()}, priority)
+    return len(missing)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Evaluate queued positions in the background")
+    parser.add_argument("--workers", type=int, default=STOCKFISH_WORKERS, help="number of engine processes")
+    parser.add_argument("--batch", type=int, default=EVAL_SERVICE_BATCH, help="positions claimed at a time")
+    parser.add_argument("--checkpoint", type=int, default=EVAL_CHECKPOINT, help="positions per commit")
+    parser.add_argument("--exit-when-empty", action="store_true", help="stop once the queue is empty")
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    evaluated = serve(workers=args.workers, batch=args.batch, checkpoint=args.checkpoint,
+                      exit_when_empty=args.exit_when_empty)
+    end_time = datetime.now()
+
+    print(f"evaluated {evaluated} positions, runtime: {str(end_time - start_time)[:-3]}")
+
+
+if __name__ == "__main__":
+    try:
+        run()
+    except KeyboardInterrupt:
+        pass
@@ -1,10 +1,16 @@
-import progressbar
 import sys
 import math
 from datetime import datetime
 import chess.pgn
 from database import Db
-from stockfish_analysis import get_stockfish_eval
+from games import count_games, stream_games
+from stockfish_analysis import evaluate_many, eval_to_pawns
+from eval_cache import EvalCache
+from eval_service import EVAL_SERVICE, request_evaluations, wait_for_evaluations
+from positions import position_key, PrefixReplay
+from blunder_scoring import average_blunders
+from metrics import ProgressBar, stage
+import parquet_store
 import collections
 
 import pprint
@@ -14,160 +20,133 @@ pp = pprint.PrettyPrinter()
 # Generates dictionaries with the keys as the most common positions reached at the desired elo
 def generate_common_positions(desired_elo=1500, elo_buffer=200, starting_moves="none"):
 
-    # Connect to database
-    DB = Db()
-    DB.execute("USE chess_analysis")
-
-    # Select all games within a certain buffer of the desired elo
-    if not starting_moves == "none":
-        games = DB.execute("SELECT * FROM opening_moves WHERE elo >= %s AND elo <= %s AND moves LIKE %s ORDER BY moves",
-                        (desired_elo - elo_buffer, desired_elo + elo_buffer, starting_moves + "%"))
+    # Read the games from the Parquet dataset if one has been written (python parquet_store.py export)
+    DB = None
+    if parquet_store.has_games():
+        table = parquet_store.load_games(desired_elo, elo_buffer, starting_moves)
+        game_count = table.num_rows
+        games = parquet_store.table_rows(table)
     else:
-        games = DB.execute("SELECT * FROM opening_moves WHERE elo >= %s AND elo <= %s ORDER BY moves",
-                       (desired_elo - elo_buffer, desired_elo + elo_buffer))
+        # Connect to database
+        DB = Db()
 
+        # Stream all games within a certain buffer of the desired elo
+        game_count = count_games(DB, desired_elo, elo_buffer, starting_moves)
+        games = stream_games(DB, desired_elo, elo_buffer, starting_moves)
+
+    # Positions are keyed by their Zobrist key, see positions.position_key
     # key: common position, value: list containing all played following positions
     pos_dict = dict()
     # key: common position, value: openings that can reach this position
     opening_dict = dict()
+    # key: position, value: FEN of the position, for evaluation and display
+    fen_dict = dict()
 
     # Create progress bar
     print("Generating common positions...")
-    widgets = [
-        ' [', progressbar.Timer(), '] ',
-        progressbar.Bar(marker='☺'),
-        ' (', progressbar.ETA(), ') '
-    ]
-    bar = progressbar.ProgressBar(
-        widgets=widgets, max_value=len(games)).start()
+    bar = ProgressBar(game_count)
+
+    # Board shared by all games, and the keys of the positions along its moves
+    replay = PrefixReplay()
+    keys = [position_key(replay.board)]
 
     # Loop through each game
-    for index, game in enumerate(games):
+    for index, (moves, opening) in enumerate(games):
 
         # Update progress bar
         bar.update(index + 1)
 
         # Get game moves
-        moves = game["moves"].split()
-
-        # Get game opening
-        opening = game["opening"]
-
-        # Create a board
-        # chess_game = chess.pgn.Game()
-        board = chess.Board()
-        prev_fen, curr_fen = None, None
+        moves = moves.split()
+
+        # Games are sorted by moves, so only replay the moves that differ from the previous game
+        # keys[i] is the position after i moves
+        common = replay.rewind(moves)
+        del keys[common + 1:]
+        for move in moves[common:]:
+            replay.push(move)
+            curr_key = position_key(replay.board)
+            if curr_key not in fen_dict:
+                fen_dict[curr_key] = replay.board.fen()
+            keys.append(curr_key)
 
         # Loop through each move
-        for index, move in enumerate(moves):
+        for index in range(len(moves)):
 
-            # Get FENs of current move and following move
-            prev_fen = curr_fen
-            board.push_san(move)
-            curr_fen = board.fen()
+            # Get keys of current move and following move
+            prev_key, curr_key = keys[index], keys[index + 1]
 
-            # After move 3, add the current fen to the list of positions corresponding to the previous fen's key
-            # Also add current opening to the list of openings corresponding to the previous fen's key
+            # After move 3, add the current position to the list of positions corresponding to the previous position
+            # Also add current opening to the list of openings corresponding to the previous position
             min_move_num = 3
             if index > 2*(min_move_num-1)-1:
-                pos_dict.setdefault(prev_fen, []).append(curr_fen)
+                pos_dict.setdefault(prev_key, []).append(curr_key)
 
-                if prev_fen not in opening_dict or opening not in opening_dict[prev_fen]:
-                    opening_dict.setdefault(prev_fen, []).append(opening)
+                if prev_key not in opening_dict or opening not in opening_dict[prev_key]:
+                    opening_dict.setdefault(prev_key, []).append(opening)
 
     # Finish progress bar
     bar.finish()
     print("\n")
 
     # only keep positions that are achieved at least once in every 1000 games and are after a certain move number
-    min_occurrences = len(games) * 0.001
+    min_occurrences = game_count * 0.001
     min_move_num = 5
     pos_dict = {k: v for k, v in pos_dict.items() if len(
-        v) >= min_occurrences and int(k.split()[-1]) >= min_move_num}
+        v) >= min_occurrences and int(fen_dict[k].split()[-1]) >= min_move_num}
 
     # Close database connection
-    DB.close_connection()
-    return pos_dict, opening_dict
+    if DB:
+        DB.close_connection()
+    return pos_dict, opening_dict, fen_dict
 
 
 # Finds common blunders based on a list of common positions
-def find_common_blunders(pos_dict, color="none"):
+def find_common_blunders(pos_dict, fen_dict, color="none"):
 
     # Connect to database
     DB = Db()
-    DB.execute("USE chess_analysis")
 
-    blunder_eval_dict = dict()  # Key: common FEN positions that are followed by a blunder,
-    # Value: tuple containing current evaluation and average evaluation of following moves
-    stored_evals = DB.execute("SELECT * from fen_evaluations")
-    stored_evals = {fen_eval["fen"]: float(fen_eval["evaluation"]) for fen_eval in stored_evals}  # Key: FEN positions
-    # Value: stockfish evaluation of FEN positions
-
-    # Create progress bar
+    eval_cache = EvalCache(DB)
+
+    # Look up evaluations of every position involved, then evaluate the missing ones across the engine pool
+    positions = {pos for curr_pos, next_pos in pos_dict.items() for pos in [curr_pos, *next_pos]}
+    stored_evals = eval_cache.get_many(positions)  # Key: positions, Value: stockfish evaluation of positions
+    missing = positions - stored_evals.keys()
+
+    # Leave the engine work to the evaluation service (python eval_service.py) if it's enabled
+    if EVAL_SERVICE != "off":
+        request_evaluations(eval_cache, {pos: fen_dict[pos] for pos in missing})
+    if EVAL_SERVICE == "wait":
+        print(f"Waiting for the evaluation service to evaluate {len(missing)} new positions...")
+        bar = ProgressBar(len(missing))
+        stored_evals.update(wait_for_evaluations(eval_cache, missing, callback=bar.update))
+        bar.finish()
+        print("\n")
+    elif EVAL_SERVICE == "partial":
+        # Only keep positions whose evaluations are all available
+        print(f"{len(missing)} positions queued for the evaluation service, continuing without them...")
+        pos_dict = {pos: next_pos for pos, next_pos in pos_dict.items()
+                    if pos in stored_evals and all(new_pos in stored_evals for new_pos in next_pos)}
+    else:
+        print(f"Evaluating {len(missing)} new positions...")
+        bar = ProgressBar(len(missing))
+        missing_fens = {fen_dict[pos]: pos for pos in missing}
+        for index, (fen, eval, depth) in enumerate(evaluate_many(missing_fens)):
+            bar.update(index + 1)
+            pos = missing_fens[fen]
+            stored_evals[pos] = eval_to_pawns(eval)
+            eval_cache.put(pos, stored_evals[pos], fen, depth)
+        eval_cache.flush()
+        bar.finish()
+        print("\n")
+
+    # Average the following evaluations of every common position and keep the ones followed by a blunder
     print("Finding common blunders...")
-    widgets = [
-        ' [', progressbar.Timer(), '] ',
-        progressbar.Bar(marker='☺'),
-        ' (', progressbar.ETA(), ') '
-    ]
-    bar = progressbar.ProgressBar(
-        widgets=widgets, max_value=len(pos_dict)).start()
-
-    # Loop through all common positions and the immediate following moves
-    for index, curr_pos in enumerate(pos_dict):
-
-        # Update progress bar
-        bar.update(index + 1)
-
-        # Get list of all following positions
-        next_pos = pos_dict[curr_pos]
-        mate_eval = 5
-
-        # Get stockfish evaluation of current position
-        if curr_pos in stored_evals:
-            curr_eval = stored_evals[curr_pos]
-        else:
-            eval = get_stockfish_eval(curr_pos)
-            curr_eval = round(
-                eval["value"] * 0.01, 2) if eval["type"] == "cp" else math.copysign(mate_eval, eval["value"])
-            stored_evals[curr_pos] = curr_eval
-            DB.execute("INSERT INTO fen_evaluations (fen, evaluation) VALUES (%s, %s)", (curr_pos, curr_eval))
-
-        # Loop through following positions and sum all of their evaluations
-        sum_next_evals = 0
-        for new_pos in next_pos:
-
-            if new_pos in stored_evals:
-                new_eval = stored_evals[new_pos]
-            else:
-                eval = get_stockfish_eval(new_pos)
-                new_eval = round(eval["value"] * 0.01, 2) if eval["type"] == "cp" else math.copysign(mate_eval, eval["value"])
-                stored_evals[new_pos] = new_eval
-                DB.execute("INSERT INTO fen_evaluations (fen, evaluation) VALUES (%s, %s)", (new_pos, new_eval))
-
-            sum_next_evals += new_eval
-
-        # Calculate average evaluation of all following positions
-        avg_next_eval = round(sum_next_evals / len(next_pos), 2)
-
-        # Store the position if the average next position eval is over 0.5 away from current eval and the next position eval is over +/-1 for the desired color
-        eval_buffer = 0.5
-        min_next_eval = 1
-        if abs(avg_next_eval - curr_eval >= eval_buffer):
-            if (color == "none" and abs(avg_next_eval) >= min_next_eval or
-                color == "white" and avg_next_eval >= min_next_eval or
-                color == "black" and avg_next_eval <= -1 * min_next_eval):
-                blunder_eval_dict[curr_pos] = (curr_eval, avg_next_eval)
-
-    # Sort positions in blunder_eval_dict from largest blunders to smallest blunders
-    blunder_eval_dict = {k: v for k, v in sorted(
-        blunder_eval_dict.items(), key=lambda pos: abs(pos[1][1] - pos[1][0]), reverse=True)}
-
-    # Finish progress bar
-    bar.finish()
-    print("\n")
+    blunder_eval_dict = average_blunders(pos_dict, stored_evals, color)
 
     # Close database connection
+    eval_cache.close()
     DB.close_connection()
     return blunder_eval_dict
 
@@ -197,16 +176,19 @@ def run():
 
     start_time = datetime.now()
 
-    pos_dict, opening_dict = generate_common_positions(
-        desired_elo=desired_elo, elo_buffer=elo_buffer, starting_moves=starting_moves)
+    with stage("generate_common_positions"):
+        pos_dict, opening_dict, fen_dict = generate_common_positions(
+            desired_elo=desired_elo, elo_buffer=elo_buffer, starting_moves=starting_moves)
     checkpoint1 = datetime.now()
     for k,v in list(pos_dict.items())[:5]:
-        print(k,v)
+        print(fen_dict[k], [fen_dict[pos] for pos in v])
 
-    blunder_eval_dict = find_common_blunders(pos_dict, color)
+    with stage("find_common_blunders"):
+        blunder_eval_dict = find_common_blunders(pos_dict, fen_dict, color)
     checkpoint2 = datetime.now()
 
-    good_openings = generate_good_openings(opening_dict, blunder_eval_dict)
+    with stage("generate_good_openings"):
+        good_openings = generate_good_openings(opening_dict, blunder_eval_dict)
     checkpoint3 = datetime.now()
 
     # Print blunder evaluations
@@ -215,10 +197,10 @@ def run():
 
     # Print positions following best positions
     best_pos = next(iter(blunder_eval_dict))
-    next_moves = collections.Counter(pos_dict[best_pos])
+    next_moves = collections.Counter(fen_dict[pos] for pos in pos_dict[best_pos])
     next_moves = sorted(next_moves.items(),
                         key=lambda move: move[1], reverse=True)
-    print(f"\nMoves after {best_pos}:")
+    print(f"\nMoves after {fen_dict[best_pos]}:")
     # pp.pprint(next_moves)
 
     # Print best openings
@@ -236,4 +218,5 @@ def run():
         f"generate_good_openings runtime: {str(checkpoint3 - checkpoint2)[:-3]}")
     
 
-run()
+if __name__ == "__main__":
+    run()
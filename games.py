@@ -0,0 +1,61 @@
+# Queries over the opening_moves table shared by the opening tree and common position builders
+
+# Max number of names per SELECT ... IN (...) query
+LOOKUP_BATCH = 1000
+
+
+def game_filter(desired_elo=1500, elo_buffer=200, starting_moves="none"):
+    if not starting_moves == "none":
+        return ("WHERE elo >= %s AND elo <= %s AND moves LIKE %s",
+                (desired_elo - elo_buffer, desired_elo + elo_buffer, starting_moves + "%"))
+    return ("WHERE elo >= %s AND elo <= %s",
+            (desired_elo - elo_buffer, desired_elo + elo_buffer))
+
+
+def count_query(desired_elo=1500, elo_buffer=200, starting_moves="none"):
+    where, arguments = game_filter(desired_elo, elo_buffer, starting_moves)
+    return f"SELECT COUNT(*) AS games FROM opening_moves {where}", arguments
+
+
+def stream_query(desired_elo=1500, elo_buffer=200, starting_moves="none"):
+    where, arguments = game_filter(desired_elo, elo_buffer, starting_moves)
+    return ("SELECT moves, openings.name FROM opening_moves "
+            f"JOIN openings ON openings.id = opening_moves.opening_id {where} ORDER BY moves", arguments)
+
+
+def count_games(DB, desired_elo=1500, elo_buffer=200, starting_moves="none"):
+    return DB.execute(*count_query(desired_elo, elo_buffer, starting_moves))[0]["games"]
+
+
+# Yield (moves, opening) tuples of all games within a certain buffer of the desired elo, sorted by moves
+# Rows are fetched in chunks through an unbuffered cursor so the result set is never held in memory
+def stream_games(DB, desired_elo=1500, elo_buffer=200, starting_moves="none"):
+    yield from DB.stream(*stream_query(desired_elo, elo_buffer, starting_moves))
+
+
+# Opening and time control names are stored once in the openings and time_controls tables (see migrations/003)
+# Ids are cached per instance, the database is only queried for names it hasn't seen yet
+class GameDimensions:
+    def __init__(self, DB):
+        self.DB = DB
+        self.ids = {"openings": dict(), "time_controls": dict()}
+
+    def _ids(self, table, names):
+        ids = self.ids[table]
+        new = [name for name in set(names) if name not in ids]
+        if new:
+            self.DB.executemany(f"INSERT IGNORE INTO {table} (name) VALUES (%s)", [(name,) for name in new])
+            for i in range(0, len(new), LOOKUP_BATCH):
+                chunk = new[i:i + LOOKUP_BATCH]
+                rows = self.DB.execute(f"SELECT id, name FROM {table} WHERE name IN ({', '.join(['%s'] * len(chunk))})",
+                                       tuple(chunk))
+                ids.update((row["name"], row["id"]) for row in rows or [])
+        return ids
+
+    # Replace the opening and time control names of (moves, elo, opening, time_control, pgn_id, game_id) rows
+    # by their ids
+    def encode(self, rows):
+        openings = self._ids("openings", (row[2] for row in rows))
+        time_controls = self._ids("time_controls", (row[3] for row in rows))
+        return [(moves, elo, openings[opening], time_controls[time_control], pgn_id, game_id)
+                for moves, elo, opening, time_control, pgn_id, game_id in rows]
@@ -0,0 +1,311 @@
+import os
+import re
+import time
+import sqlite3
+import argparse
+import threading
+import traceback
+import multiprocessing
+from datetime import datetime
+from database import Db
+from games import GameDimensions
+from stream_pgn import stream_source
+from store_openings import scan_games, parse_game, insert_query, insert_columns
+from opening_tree import OpeningTree
+from eval_cache import EvalCache
+import eval_service
+import parquet_store
+import tree_store
+from metrics import GAMES_PARSED, stage
+
+# Pipeline configuration, overridable through environment variables
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", max((os.cpu_count() or 1) - 2, 1)))
+INGEST_BATCH_BYTES = int(os.getenv("INGEST_BATCH_BYTES", 4 * 1024 * 1024))
+# Number of sources decompressed at the same time, they share the parsing workers
+INGEST_FILES = int(os.getenv("INGEST_FILES", 2))
+# Progress is checkpointed every INGEST_CHECKPOINT batches, a resumed ingest starts from the last checkpoint
+INGEST_CHECKPOINT = int(os.getenv("INGEST_CHECKPOINT", 10))
+INGEST_PROGRESS_PATH = os.getenv("INGEST_PROGRESS_PATH", "ingest_progress.sqlite")
+
+# Every game in a lichess dump starts with an [Event ...] header after a blank line
+game_boundary = b"\n\n[Event "
+
+
+# pgn_id of a lichess monthly dump is its year and month, e.g. 202106, or -1 for other files
+def get_pgn_id(source):
+    match = re.search(r"(\d{4})-(\d{2})\.pgn", source)
+    return int(match.group(1) + match.group(2)) if match else -1
+
+
+# Read pgn_list.txt style files, one source per line
+def read_source_list(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# Cut a decompressed byte stream into batches that only contain complete games
+def split_games(byte_chunks, batch_bytes=INGEST_BATCH_BYTES):
+    buffer = bytearray()
+    for chunk in byte_chunks:
+        buffer += chunk
+        if len(buffer) < batch_bytes:
+            continue
+        cut = buffer.rfind(game_boundary)
+        if cut <= 0:
+            continue
+        yield bytes(buffer[:cut + 2])
+        del buffer[:cut + 2]
+
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+# Ingestion progress of every source, kept in a SQLite file: the decompressed byte offset and the number of games
+# up to which the source has been committed, and whether it's done
+class IngestProgress:
+    def __init__(self, path=INGEST_PROGRESS_PATH):
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, pgn_id INTEGER NOT NULL, "
+                         "byte_offset INTEGER NOT NULL, game_offset INTEGER NOT NULL, complete INTEGER NOT NULL, "
+                         "updated REAL NOT NULL)")
+
+    # Returns {source: (byte offset, game offset, complete)}
+    def load(self):
+        rows = self._db.execute("SELECT source, byte_offset, game_offset, complete FROM sources")
+        return {source: (byte_offset, game_offset, bool(complete))
+                for source, byte_offset, game_offset, complete in rows}
+
+    # checkpoints: {source: SourceProgress}
+    def save(self, checkpoints):
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        self._db.executemany("INSERT OR REPLACE INTO sources (source, pgn_id, byte_offset, game_offset, complete, "
+                             "updated) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(source, get_pgn_id(source), progress.byte_offset, progress.game_offset,
+                               progress.complete, now) for source, progress in checkpoints.items()])
+        self._db.execute("COMMIT")
+
+    # Forget the progress of sources, so they're ingested from the start
+    def reset(self, sources):
+        self._db.executemany("DELETE FROM sources WHERE source = ?", [(source,) for source in sources])
+
+    def close(self):
+        self._db.close()
+
+
+# Where a source is up to. Batches are parsed out of order, the offsets only move past a batch
+# once every batch before it has been parsed
+class SourceProgress:
+    def __init__(self, byte_offset=0, game_offset=0):
+        self.byte_offset = byte_offset
+        self.game_offset = game_offset
+        self.complete = False
+        self.next_index = 0
+        self.parsed = dict()
+
+    # end_offset is the byte offset right after the batch, last is set for the empty batch ending a source
+    def batch_parsed(self, index, end_offset, games, last):
+        self.parsed[index] = (end_offset, games, last)
+        while self.next_index in self.parsed:
+            end_offset, games, last = self.parsed.pop(self.next_index)
+            self.byte_offset = end_offset
+            self.game_offset += games
+            self.complete = last
+            self.next_index += 1
+
+
+# Decompress and split the (source, byte offset) pairs taken from source_queue, feeding batches to the parsing
+# workers as (source, pgn_id, index, end offset, batch). A None batch ends each source
+# Every reader ends with a stop signal: None, or the traceback of the error that stopped it
+def read_sources(source_queue, batch_queue):
+    error = None
+    try:
+        for source, byte_offset in iter(source_queue.get, None):
+            pgn_id = get_pgn_id(source)
+            index = 0
+            for batch in split_games(stream_source(source, byte_offset)):
+                byte_offset += len(batch)
+                batch_queue.put((source, pgn_id, index, byte_offset, batch))
+                index += 1
+            batch_queue.put((source, pgn_id, index, byte_offset, None))
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        batch_queue.put(error)
+
+
+# Batches of every reader, until all of them have stopped. A reader's error is raised here, the pool passes
+# it on to the results of imap_unordered
+# in_flight limits the batches handed to the pool but not yet taken from its results, the caller releases it
+# for every result
+def queued_batches(batch_queue, readers, options, in_flight):
+    stopped = 0
+    while stopped < readers:
+        batch = batch_queue.get()
+        if batch is None:
+            stopped += 1
+            continue
+        if isinstance(batch, str):
+            raise RuntimeError(f"Reading a source failed:\n{batch}")
+        in_flight.acquire()
+        yield (*batch, options)
+
+
+# Parse one batch of games into opening_moves rows
+# Returns (source, index, end offset, last, rows, number of games in the batch)
+def parse_batch(args):
+    source, pgn_id, index, end_offset, batch, options = args
+    rows = list()
+    games = 0
+    for headers, movetext in scan_games(batch.split(b"\n") if batch is not None else []):
+        games += 1
+        row = parse_game(headers, movetext, pgn_id, **options)
+        if row is not None:
+            rows.append(row)
+    return source, index, end_offset, batch is None, rows, games
+
+
+# Ingest PGN sources through a decompress -> split -> parse -> bulk insert pipeline
+# Up to files sources are decompressed at once, each in its own process, parsing runs in a pool of workers
+# and inserts in this process
+# Progress is checkpointed per source (see IngestProgress): complete sources are skipped and the others resume
+# from their last checkpoint, pass restart=True to ingest every source from the start
+# Games already stored are skipped by their lichess game ID, so the batches after the last checkpoint can be
+# ingested again safely
+# With load_data=True batches are sent with LOAD DATA LOCAL INFILE instead of multi-row INSERTs
+# With update_trees=True the games of every pgn_id whose sources are all ingested are merged into the persisted
+# elo bucket trees, unless the trees already have them (see tree_store.update_pgn_ids), and with prewarm=True
+# the common positions of the changed trees are queued for the evaluation service
+# With parquet_dir set games are written to that Parquet dataset instead of the database (see parquet_store),
+# progress is then kept in the dataset directory
+# Extra keyword arguments (min_elo, max_elo, validate) are passed on to store_openings.parse_game
+# Returns the number of games parsed, which includes the games skipped as already stored
+def ingest(sources, workers=INGEST_WORKERS, files=INGEST_FILES, load_data=False, update_trees=False, prewarm=False,
+           parquet_dir=None, restart=False, **options):
+    DB = Db() if parquet_dir is None else None
+    parquet_writer = parquet_store.GameWriter(parquet_dir) if parquet_dir is not None else None
+
+    ingest_progress = IngestProgress(os.path.join(parquet_dir, "_ingest_progress.sqlite") if parquet_dir
+                                     else INGEST_PROGRESS_PATH)
+    if restart:
+        ingest_progress.reset(sources)
+    checkpoints = ingest_progress.load()
+    progress = dict()
+    for source in dict.fromkeys(sources):
+        byte_offset, game_offset, complete = checkpoints.get(source, (0, 0, False))
+        if complete:
+            print(f"Skipping {source}, already ingested ({game_offset} games)")
+        else:
+            if byte_offset:
+                print(f"Resuming {source} after {game_offset} games")
+            progress[source] = SourceProgress(byte_offset, game_offset)
+
+    source_queue = multiprocessing.Queue()
+    # Bounded so decompression can't run too far ahead of the parsers
+    batch_queue = multiprocessing.Queue(maxsize=workers * 2)
+    for source, source_progress in progress.items():
+        source_queue.put((source, source_progress.byte_offset))
+    readers = [multiprocessing.Process(target=read_sources, args=(source_queue, batch_queue), daemon=True)
+               for _ in range(max(1, min(files, len(progress))))]
+    for reader in readers:
+        source_queue.put(None)
+        reader.start()
+
+    dimensions = GameDimensions(DB) if DB else None
+    game_count = 0
+    changed = dict()
+    start_time = datetime.now()
+    inserter = DB.bulk_inserter(insert_query) if DB else parquet_writer
+    with multiprocessing.Pool(workers) as pool, inserter:
+        # Bounded like batch_queue, so parsing can't run too far ahead of the inserts either
+        in_flight = threading.BoundedSemaphore(workers * 2)
+        batches = queued_batches(batch_queue, len(readers), options, in_flight)
+        for batch_count, (source, index, end_offset, last, rows, games) in enumerate(
+                pool.imap_unordered(parse_batch, batches), 1):
+            in_flight.release()
+            if parquet_writer:
+                inserter.add_many(rows)
+            elif load_data and rows:
+                DB.load_data("opening_moves", insert_columns, dimensions.encode(rows))
+            else:
+                inserter.add_many(dimensions.encode(rows))
+            GAMES_PARSED.inc(games)
+            progress[source].batch_parsed(index, end_offset, games, last)
+            changed[source] = progress[source]
+
+            # Only checkpoint games that are committed
+            if batch_count % INGEST_CHECKPOINT == 0 or last:
+                inserter.flush(commit=True)
+                ingest_progress.save(changed)
+                changed = dict()
+
+            game_count += len(rows)
+            elapsed = (datetime.now() - start_time).total_seconds()
+            print(f"\r{game_count} games parsed ({game_count / max(elapsed, 1e-9):.0f} games/s)", end="")
+
+    # Leaving the with block committed the last rows
+    ingest_progress.save(changed)
+    ingest_progress.close()
+    for reader in readers:
+        reader.join()
+    print()
+    changed_buckets = set()
+    if update_trees:
+        # The trees are built from the stored games of each pgn_id, so games skipped as already stored and games
+        # ingested before a resume are counted exactly once
+        complete = {source: progress[source].complete if source in progress else checkpoints[source][2]
+                    for source in sources}
+        pgn_ids = ({get_pgn_id(source) for source, done in complete.items() if done} -
+                   {get_pgn_id(source) for source, done in complete.items() if not done})
+        print("Updating opening trees...")
+        if parquet_dir:
+            changed_buckets = parquet_store.update_buckets(pgn_ids, parquet_dir)
+        else:
+            changed_buckets = tree_store.update_from_db(pgn_ids)
+    if prewarm and update_trees:
+        # Queue evaluations of the common positions in the changed buckets for the evaluation service
+        eval_cache = EvalCache(DB)
+        queued = 0
+        for tc_class, bucket in changed_buckets:
+            opening_tree = OpeningTree.open(tree_store.bucket_path(tc_class, bucket))
+            queued += eval_service.prewarm(opening_tree, eval_cache, max(len(opening_tree) / 100000, 1))
+        eval_cache.close()
+        print(f"Queued {queued} positions for evaluation")
+    if DB:
+        DB.close_connection()
+    return game_count
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Ingest lichess PGN dumps into opening_moves")
+    parser.add_argument("sources", nargs="*", help="URLs or local .pgn/.bz2/.zst files (default: pgn_list.txt)")
+    parser.add_argument("--list", default="pgn_list.txt", help="file with one source per line")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="number of parsing processes")
+    parser.add_argument("--files", type=int, default=INGEST_FILES, help="number of sources read at the same time")
+    parser.add_argument("--restart", action="store_true", help="ignore saved progress and ingest every source again")
+    parser.add_argument("--min-elo", type=int, help="skip games with a lower average elo")
+    parser.add_argument("--max-elo", type=int, help="skip games with a higher average elo")
+    parser.add_argument("--validate", action="store_true", help="replay every game on a board to validate its moves")
+    parser.add_argument("--load-data", action="store_true", help="bulk load with LOAD DATA LOCAL INFILE")
+    parser.add_argument("--update-trees", action="store_true", help="merge the new games into the elo bucket trees")
+    parser.add_argument("--parquet", metavar="DIR", help="write games to a partitioned Parquet dataset instead")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="queue evaluations of common positions in the updated trees (needs --update-trees)")
+    args = parser.parse_args()
+
+    sources = args.sources or read_source_list(args.list)
+
+    start_time = datetime.now()
+    with stage("ingest"):
+        game_count = ingest(sources, workers=args.workers, files=args.files, load_data=args.load_data,
+                            update_trees=args.update_trees, prewarm=args.prewarm, parquet_dir=args.parquet,
+                            restart=args.restart, min_elo=args.min_elo, max_elo=args.max_elo,
+                            validate=args.validate)
+    end_time = datetime.now()
+
+    print(f"parsed {game_count} games, runtime: {str(end_time - start_time)[:-3]}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import atexit
+import bisect
+import cProfile
+import threading
+import collections
+from contextlib import contextmanager
+import progressbar
+
+# Metrics are written to METRICS_PATH when the process exits, as JSON for a .json path and in the Prometheus
+# text format otherwise
+METRICS_PATH = os.getenv("METRICS_PATH")
+# Stages to profile, comma separated stage names or "all". PROFILE_MODE is "cprofile" for a deterministic
+# profile (.prof, open with pstats or snakeviz) or "sample" for a low overhead sampling profile written as
+# collapsed stacks (.collapsed, open with flamegraph.pl or speedscope)
+PROFILE_STAGES = {stage.strip() for stage in os.getenv("PROFILE_STAGES", "").split(",") if stage.strip()}
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+# Progress bars are redrawn at most this often, in seconds
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 0.5))
+
+# Histogram buckets, in seconds
+EVAL_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+START_TIME = time.time()
+_metrics = dict()
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+# Monotonic count, optionally split by labels
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            self.values[key] += value
+
+    def value(self, **labels):
+        return self.values.get(label_key(labels), 0)
+
+    def snapshot(self, uptime):
+        return [{"labels": dict(key), "value": value, "per_second": round(value / uptime, 3)}
+                for key, value in sorted(self.values.items())]
+
+    def prometheus(self):
+        if not self.values:
+            return [f"{self.name} 0"]
+        return [f"{self.name}{format_labels(key)} {value:g}" for key, value in sorted(self.values.items())]
+
+
+# Distribution of observed values over fixed buckets, optionally split by labels
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = dict()  # Key: labels, Value: [count per bucket (the last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    # count observes the same value several times, e.g. the average time of positions evaluated together
+    def observe(self, value, count=1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            if key not in self.series:
+                self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series = self.series[key]
+            series[0][bisect.bisect_left(self.buckets, value)] += count
+            series[1] += value * count
+            series[2] += count
+
+    def cumulative(self, key):
+        counts, total = list(), 0
+        for count in self.series[key][0]:
+            total += count
+            counts.append(total)
+        return zip([*map(str, self.buckets), "+Inf"], counts)
+
+    def snapshot(self, uptime):
+        return [{"labels": dict(key), "count": count, "sum": round(total, 6),
+                 "mean": round(total / count, 6) if count else None,
+                 "buckets": dict(self.cumulative(key))}
+                for key, (counts, total, count) in sorted(self.series.items())]
+
+    def prometheus(self):
+        lines = list()
+        for key, (counts, total, count) in sorted(self.series.items()):
+            for bound, cumulative in self.cumulative(key):
+                lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+def counter(name, help):
+    if name not in _metrics:
+        _metrics[name] = Counter(name, help)
+    return _metrics[name]
+
+
+def histogram(name, help, buckets=EVAL_BUCKETS):
+    if name not in _metrics:
+        _metrics[name] = Histogram(name, help, buckets)
+    return _metrics[name]
+
+
+GAMES_PARSED = counter("games_parsed_total", "Games read from PGN")
+ROWS_INSERTED = counter("rows_inserted_total", "Rows sent to opening_moves and other tables")
+EVAL_LOOKUPS = counter("eval_cache_lookups_total", "Evaluation cache lookups by the level that answered them "
+                                                   "(lru, local, db or miss)")
+ENGINE_EVALS = counter("engine_evals_total", "Positions evaluated by an engine")
+ENGINE_EVAL_SECONDS = histogram("engine_eval_seconds", "Engine time per evaluated position")
+TREE_NODES = counter("tree_nodes_created_total", "Opening tree nodes created")
+STAGE_SECONDS = histogram("stage_seconds", "Wall time of pipeline stages", STAGE_BUCKETS)
+
+
+# All metrics as a JSON-serializable dict, with the evaluation cache hit rate worked out
+def snapshot():
+    uptime = max(time.time() - START_TIME, 1e-9)
+    lookups = {dict(key)["result"]: value for key, value in EVAL_LOOKUPS.values.items()}
+    total_lookups = sum(lookups.values())
+    return {
+        "uptime_seconds": round(uptime, 3),
+        "eval_cache_hit_rate": round(1 - lookups.get("miss", 0) / total_lookups, 4) if total_lookups else None,
+        "metrics": {name: {"type": metric.kind, "help": metric.help, "values": metric.snapshot(uptime)}
+                    for name, metric in _metrics.items()},
+    }
+
+
+def prometheus():
+    lines = list()
+    for name, metric in _metrics.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        lines.extend(metric.prometheus())
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path=METRICS_PATH):
+    with open(path, "w") as f:
+        if path.endswith(".json"):
+            json.dump(snapshot(), f, indent=2)
+        else:
+            f.write(prometheus())
+
+
+if METRICS_PATH:
+    atexit.register(write_metrics, METRICS_PATH)
+
+
+# Samples the stack of one thread every interval seconds from a background thread, counting identical stacks
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = list()
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        self._sampler.start()
+
+    def disable(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def dump_stats(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+# Only one cProfile profiler can run at a time, nested stages aren't profiled separately
+_profiling = False
+
+
+def profiled(name):
+    return not _profiling and ("all" in PROFILE_STAGES or name in PROFILE_STAGES)
+
+
+# Time a pipeline stage into stage_seconds, and profile it if it's listed in PROFILE_STAGES
+@contextmanager
+def stage(name):
+    global _profiling
+    profiler = None
+    if profiled(name):
+        profiler = SamplingProfiler() if PROFILE_MODE == "sample" else cProfile.Profile()
+        _profiling = True
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+        if profiler:
+            profiler.disable()
+            _profiling = False
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            extension = "collapsed" if PROFILE_MODE == "sample" else "prof"
+            path = os.path.join(PROFILE_DIR, f"{name.replace(' ', '_')}-{os.getpid()}.{extension}")
+            profiler.dump_stats(path)
+            print(f"Profile of {name} written to {path}")
+
+
+# Progress bar with the usual widgets, redrawn at most every interval seconds
+# so updating it for every game or position costs next to nothing
+class ProgressBar:
+    def __init__(self, max_value, interval=PROGRESS_INTERVAL):
+        widgets = [
+            ' [', progressbar.Timer(), '] ',
+            progressbar.Bar(marker='☺'),
+            ' (', progressbar.ETA(), ') '
+        ]
+        self.bar = progressbar.ProgressBar(widgets=widgets, max_value=max_value).start()
+        self.interval = interval
+        self._next_update = 0
+
+    def update(self, value):
+        now = time.monotonic()
+        if now >= self._next_update:
+            self.bar.update(value)
+            self._next_update = now + self.interval
+
+    def finish(self):
+        self.bar.finish()
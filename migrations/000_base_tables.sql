@@ -0,0 +1,12 @@
+-- Tables as originally created by hand, so a new database can be built by running every migration in order
+CREATE TABLE IF NOT EXISTS opening_moves (
+    moves VARCHAR(400) NOT NULL,
+    elo FLOAT NOT NULL,
+    opening VARCHAR(255) NOT NULL,
+    time_control VARCHAR(32) NOT NULL,
+    pgn_id INT NOT NULL DEFAULT -1
+);
+CREATE TABLE IF NOT EXISTS fen_evaluations (
+    fen VARCHAR(100) NOT NULL,
+    evaluation FLOAT NOT NULL
+);
@@ -0,0 +1,4 @@
+-- Identify evaluated positions by their 64-bit polyglot Zobrist key, the FEN is kept for display
+-- Keys of existing rows are filled in by `python schema.py migrate` before 003, or by `python positions.py`
+ALTER TABLE fen_evaluations ADD COLUMN pos_key BIGINT NULL;
+CREATE INDEX fen_evaluations_pos_key ON fen_evaluations (pos_key);
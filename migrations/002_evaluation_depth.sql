@@ -0,0 +1,3 @@
+-- Search depth reached by each evaluation, so shallow adaptive evaluations can be told apart and upgraded
+-- Existing rows keep a NULL depth, they were all searched to full depth
+ALTER TABLE fen_evaluations ADD COLUMN depth SMALLINT NULL;
@@ -0,0 +1,66 @@
+-- Managed schema for opening_moves and fen_evaluations
+-- fen_evaluations rows without a pos_key aren't kept, `python schema.py migrate` fills in their keys first
+-- The old tables are kept as opening_moves_old and fen_evaluations_old, drop them once the new ones are checked
+
+-- Opening and time control names are stored once, games refer to them by id
+-- Binary collation so names that only differ in case get their own id
+CREATE TABLE openings (
+    id MEDIUMINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(255) COLLATE utf8mb4_bin NOT NULL,
+    UNIQUE KEY openings_name (name)
+);
+CREATE TABLE time_controls (
+    id SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(32) COLLATE utf8mb4_bin NOT NULL,
+    UNIQUE KEY time_controls_name (name)
+);
+INSERT IGNORE INTO openings (name) SELECT DISTINCT opening FROM opening_moves;
+INSERT IGNORE INTO time_controls (name) SELECT DISTINCT time_control FROM opening_moves;
+
+-- Games are range partitioned by elo so an elo window only reads the partitions it overlaps
+-- (elo, moves) serves the elo window scan, (moves, elo) the starting moves filter (moves LIKE 'prefix%')
+-- MySQL needs the partitioning column in every unique key, hence the (id, elo) primary key
+CREATE TABLE opening_moves_partitioned (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    moves VARCHAR(400) NOT NULL,
+    elo DECIMAL(5, 1) NOT NULL,
+    opening_id MEDIUMINT UNSIGNED NOT NULL,
+    time_control_id SMALLINT UNSIGNED NOT NULL,
+    pgn_id INT NOT NULL DEFAULT -1,
+    PRIMARY KEY (id, elo),
+    KEY opening_moves_elo_moves (elo, moves(64)),
+    KEY opening_moves_moves_elo (moves(64), elo)
+)
+PARTITION BY RANGE (FLOOR(elo)) (
+    PARTITION p0 VALUES LESS THAN (1000),
+    PARTITION p1000 VALUES LESS THAN (1200),
+    PARTITION p1200 VALUES LESS THAN (1400),
+    PARTITION p1400 VALUES LESS THAN (1600),
+    PARTITION p1600 VALUES LESS THAN (1800),
+    PARTITION p1800 VALUES LESS THAN (2000),
+    PARTITION p2000 VALUES LESS THAN (2200),
+    PARTITION p2200 VALUES LESS THAN (2400),
+    PARTITION p2400 VALUES LESS THAN (2600),
+    PARTITION p2600 VALUES LESS THAN (2800),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+INSERT INTO opening_moves_partitioned (moves, elo, opening_id, time_control_id, pgn_id)
+SELECT opening_moves.moves, opening_moves.elo, openings.id, time_controls.id, opening_moves.pgn_id
+FROM opening_moves
+JOIN openings ON openings.name = opening_moves.opening
+JOIN time_controls ON time_controls.name = opening_moves.time_control;
+RENAME TABLE opening_moves TO opening_moves_old, opening_moves_partitioned TO opening_moves;
+
+-- One row per position, keyed by its Zobrist key. Where a position was evaluated more than once the
+-- deepest evaluation is kept (NULL depths are full depth, so they sort last and win)
+CREATE TABLE fen_evaluations_keyed (
+    pos_key BIGINT NOT NULL PRIMARY KEY,
+    fen VARCHAR(100) NOT NULL,
+    evaluation DECIMAL(5, 2) NOT NULL,
+    depth SMALLINT NULL
+);
+INSERT INTO fen_evaluations_keyed (pos_key, fen, evaluation, depth)
+SELECT pos_key, fen, evaluation, depth FROM fen_evaluations WHERE pos_key IS NOT NULL
+ORDER BY depth IS NULL, depth
+ON DUPLICATE KEY UPDATE fen = VALUES(fen), evaluation = VALUES(evaluation), depth = VALUES(depth);
+RENAME TABLE fen_evaluations TO fen_evaluations_old, fen_evaluations_keyed TO fen_evaluations;
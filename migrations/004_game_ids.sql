@@ -0,0 +1,7 @@
+-- lichess game ID of every game (the last part of its Site header), so a dump that is ingested again, or resumed
+-- after a crash, doesn't store its games twice. Inserts use INSERT IGNORE and skip games already stored
+-- Games from elsewhere have a NULL ID and are never deduplicated
+-- MySQL needs the partitioning column in every unique key, elo is the same for every copy of a game
+ALTER TABLE opening_moves
+    ADD COLUMN game_id CHAR(8) CHARACTER SET ascii COLLATE ascii_bin NULL,
+    ADD UNIQUE KEY opening_moves_game_id (game_id, elo);
@@ -0,0 +1,2 @@
+-- Incremental tree updates (python tree_store.py --update) read the games of one pgn_id at a time
+ALTER TABLE opening_moves ADD KEY opening_moves_pgn_id (pgn_id);
@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from collections.abc import Mapping
+import chess
+from positions import position_key, PrefixReplay
+
+NO_NODE = -1
+
+# Tree file format, version 2:
+#   magic, uint32 header length, JSON header, padding, then every node array at an 8-byte aligned offset
+# The header holds the version, byte order, each array's typecode, length and offset from the start of
+# the array data, and the interned SAN move and opening name tables
+# Arrays are stored in native byte order so they can be used straight from an mmap (or numpy.memmap)
+TREE_MAGIC = b"OTREE"
+TREE_VERSION = 2
+TREE_ALIGNMENT = 8
+ARRAY_NAMES = ("parent", "move", "count", "first_child", "next_sibling", "key",
+               "opening_head", "opening_id", "opening_next")
+
+
+def align(offset):
+    return -(-offset // TREE_ALIGNMENT) * TREE_ALIGNMENT
+
+
+# Typecode of an array or of a memoryview over a mapped tree file
+def typecode_of(values):
+    return values.typecode if isinstance(values, array) else values.format
+
+
+# Opening tree stored as parallel arrays (struct of arrays) instead of one object per node
+# Node 0 is the starting position, every other node is reached by playing move[node] from parent[node]
+# Children of a node form a linked list through first_child/next_sibling
+# Moves and openings are interned, nodes only store their index in self.moves / self.openings
+class OpeningTree:
+    def __init__(self):
+        self.parent = array('i')
+        self.move = array('H')
+        self.count = array('I')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.key = array('q')
+
+        # Openings that reach each node, as linked lists in a shared pool
+        self.opening_head = array('i')
+        self.opening_id = array('I')
+        self.opening_next = array('i')
+
+        self.moves, self._move_ids = list(), dict()
+        self.openings, self._opening_ids = list(), dict()
+        self._reset_builder()
+
+        self._add_node(NO_NODE, 0, position_key(chess.Board()))
+
+    def _reset_builder(self):
+        # Path and opening of the last game added, games sorted by moves share most of it
+        self._path, self._last_moves, self._last_opening = [0], list(), None
+        self._replay = PrefixReplay()
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _intern(self, value, table, ids):
+        if value not in ids:
+            ids[value] = len(table)
+            table.append(value)
+        return ids[value]
+
+    def _add_node(self, parent, move_id, key):
+        node = len(self.parent)
+        self.parent.append(parent)
+        self.move.append(move_id)
+        self.count.append(0)
+        self.first_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self.key.append(key)
+        self.opening_head.append(NO_NODE)
+
+        if parent != NO_NODE:
+            self.next_sibling[node] = self.first_child[parent]
+            self.first_child[parent] = node
+        return node
+
+    # Find the child of a node reached by a SAN move, or NO_NODE
+    def find_child(self, node, san):
+        move_id = self._move_ids.get(san)
+        if move_id is None:
+            return NO_NODE
+        child = self.first_child[node]
+        while child != NO_NODE and self.move[child] != move_id:
+            child = self.next_sibling[child]
+        return child
+
+    def children(self, node):
+        child = self.first_child[node]
+        while child != NO_NODE:
+            yield child
+            child = self.next_sibling[child]
+
+    def add_opening(self, node, opening):
+        opening_id = self._intern(opening, self.openings, self._opening_ids)
+        entry = self.opening_head[node]
+        while entry != NO_NODE:
+            if self.opening_id[entry] == opening_id:
+                return
+            entry = self.opening_next[entry]
+
+        self.opening_id.append(opening_id)
+        self.opening_next.append(self.opening_head[node])
+        self.opening_head[node] = len(self.opening_id) - 1
+
+    def node_openings(self, node):
+        openings = list()
+        entry = self.opening_head[node]
+        while entry != NO_NODE:
+            openings.append(self.openings[self.opening_id[entry]])
+            entry = self.opening_next[entry]
+        return openings[::-1]
+
+    # Add one game to the tree, creating nodes for moves that haven't been seen after this position
+    # Works in any order, but games sorted by moves are much faster: the path shared with the previous
+    # game is reused, and the board is only replayed when a new node needs its position key
+    def add_game(self, moves, opening):
+        common = 0
+        limit = min(len(moves), len(self._last_moves))
+        while common < limit and moves[common] == self._last_moves[common]:
+            common += 1
+        del self._path[common + 1:]
+
+        node = self._path[-1]
+        for depth in range(common, len(moves)):
+            move = moves[depth]
+            child = self.find_child(node, move)
+            if child == NO_NODE:
+                self._replay.play(moves[:depth + 1])
+                child = self._add_node(node, self._intern(move, self.moves, self._move_ids),
+                                       position_key(self._replay.board))
+            self._path.append(child)
+            node = child
+
+        # Nodes on the shared path already have this opening if the previous game had the same one
+        skip_openings = common if opening == self._last_opening else 0
+        self.count[0] += 1
+        for depth, node in enumerate(self._path[1:]):
+            self.count[node] += 1
+            if depth >= skip_openings:
+                self.add_opening(node, opening)
+
+        self._last_moves, self._last_opening = moves, opening
+
+    def path(self, node):
+        moves = list()
+        while node > 0:
+            moves.append(self.moves[self.move[node]])
+            node = self.parent[node]
+        return moves[::-1]
+
+    # Rebuild the board of a node by replaying its moves from the starting position
+    def board(self, node):
+        board = chess.Board()
+        for move in self.path(node):
+            board.push_san(move)
+        return board
+
+    def fen(self, node):
+        return self.board(node).fen()
+
+    def node_key(self, node):
+        if self.key is None:
+            return position_key(self.board(node))
+        return self.key[node]
+
+    # Add all nodes of another tree to this one, summing counts and combining openings
+    # With prefix (a list of SAN moves), only games starting with those moves are merged, like the
+    # moves LIKE 'prefix%' filter: moves are compared case-insensitively and the last one only has to start
+    # with the given text ("e4 e" matches e4 e5 and e4 e6). The moves leading to the matched nodes only get
+    # the counts and openings of the matched games
+    def merge(self, other, prefix=None):
+        prefix = [move.lower() for move in prefix or list()]
+        mapping = array('i', [NO_NODE]) * len(other)
+        self._reset_builder()
+
+        matched = [0]
+        for depth, move in enumerate(prefix, 1):
+            matched = [child for node in matched for child in other.children(node)
+                       if (other.moves[other.move[child]].lower().startswith(move) if depth == len(prefix)
+                           else other.moves[other.move[child]].lower() == move)]
+
+        for node in matched:
+            path = list()
+            ancestor = node
+            while ancestor != 0:
+                path.append(ancestor)
+                ancestor = other.parent[ancestor]
+            self.count[0] += other.count[node]
+            child = 0
+            for ancestor in reversed(path):
+                child = self._merge_node(child, other, ancestor, node)
+            mapping[node] = child
+
+        # Parents come before their children, so every node below a matched node finds its parent mapped
+        for node in range(1, len(other)):
+            if mapping[node] != NO_NODE:
+                continue
+            parent = mapping[other.parent[node]]
+            if parent != NO_NODE:
+                mapping[node] = self._merge_node(parent, other, node, node)
+
+    # Add node of other under parent, with the count and openings of other's node source, returns the new node
+    def _merge_node(self, parent, other, node, source):
+        move = other.moves[other.move[node]]
+        child = self.find_child(parent, move)
+        if child == NO_NODE:
+            child = self._add_node(parent, self._intern(move, self.moves, self._move_ids), other.node_key(node))
+        self.count[child] += other.count[source]
+        for opening in other.node_openings(source):
+            self.add_opening(child, opening)
+        return child
+
+    # Write the tree in the versioned binary format, see TREE_VERSION
+    # Position keys can be left out to save space, they are then rebuilt from the moves when needed
+    # The file is written next to path and moved over it, so trees already mapped from path (see open) keep
+    # reading the old file instead of a half-written one
+    def save(self, path, keys=True):
+        names = [name for name in ARRAY_NAMES if keys or name != "key"]
+        arrays, offset = dict(), 0
+        for name in names:
+            values = getattr(self, name)
+            arrays[name] = [typecode_of(values), len(values), offset]
+            offset += align(len(values) * values.itemsize)
+
+        header = json.dumps({
+            "version": TREE_VERSION,
+            "byteorder": sys.byteorder,
+            "arrays": arrays,
+            "moves": self.moves,
+            "openings": self.openings,
+        }).encode()
+
+        with open(path + ".tmp", "wb") as f:
+            f.write(TREE_MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            f.write(bytes(align(f.tell()) - f.tell()))
+            for name in names:
+                data = getattr(self, name).tobytes()
+                f.write(data)
+                f.write(bytes(align(len(data)) - len(data)))
+        os.replace(path + ".tmp", path)
+
+    # Open a tree file without reading it: node arrays are memoryviews over a read-only mmap,
+    # so processes opening the same file share one page-cached copy. The tree can't be modified
+    @classmethod
+    def open(cls, path):
+        return cls._read(path, copy=False)
+
+    # Load a tree file into regular arrays that can be modified
+    @classmethod
+    def load(cls, path):
+        return cls._read(path, copy=True)
+
+    @classmethod
+    def _read(cls, path, copy):
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if data[:len(TREE_MAGIC)] != TREE_MAGIC:
+            data.close()
+            raise ValueError(f"{path} is not an opening tree file")
+        header_length, = struct.unpack_from("<I", data, len(TREE_MAGIC))
+        header_start = len(TREE_MAGIC) + 4
+        header = json.loads(data[header_start:header_start + header_length])
+        if header.get("version") != TREE_VERSION or header["byteorder"] != sys.byteorder:
+            data.close()
+            raise ValueError(f"{path} has an unsupported tree format, rebuild it with python tree_store.py")
+
+        tree = cls.__new__(cls)
+        tree.key = None
+        data_start = align(header_start + header_length)
+        buffer = memoryview(data)
+        for name, (typecode, length, offset) in header["arrays"].items():
+            start = data_start + offset
+            raw = buffer[start:start + length * array(typecode).itemsize]
+            if copy:
+                values = array(typecode)
+                values.frombytes(raw)
+                raw.release()
+            else:
+                values = raw.cast(typecode)
+            setattr(tree, name, values)
+
+        if copy:
+            buffer.release()
+            data.close()
+            if tree.key is None:
+                raise ValueError(f"{path} was saved without position keys, use OpeningTree.open to read it")
+        else:
+            tree._mmap = data
+
+        tree.moves = header["moves"]
+        tree._move_ids = {move: index for index, move in enumerate(tree.moves)}
+        tree.openings = header["openings"]
+        tree._opening_ids = {opening: index for index, opening in enumerate(tree.openings)}
+        tree._reset_builder()
+        return tree
+
+    @property
+    def root(self):
+        return TreeNodeView(self, 0)
+
+
+# Read-only view of one node, with the same attributes the old TreeNode objects had
+class TreeNodeView:
+    __slots__ = ("tree", "node_num")
+
+    def __init__(self, tree, node_num):
+        self.tree = tree
+        self.node_num = node_num
+
+    @property
+    def count(self):
+        return self.tree.count[self.node_num]
+
+    @property
+    def key(self):
+        return self.tree.node_key(self.node_num)
+
+    @property
+    def fen(self):
+        return self.tree.fen(self.node_num)
+
+    @property
+    def openings(self):
+        return self.tree.node_openings(self.node_num)
+
+    @property
+    def next_tree(self):
+        return ChildrenView(self.tree, self.node_num)
+
+
+# Mapping of SAN move -> TreeNodeView over the children of a node
+class ChildrenView(Mapping):
+    __slots__ = ("tree", "node")
+
+    def __init__(self, tree, node):
+        self.tree = tree
+        self.node = node
+
+    def __getitem__(self, san):
+        child = self.tree.find_child(self.node, san)
+        if child == NO_NODE:
+            raise KeyError(san)
+        return TreeNodeView(self.tree, child)
+
+    def __iter__(self):
+        for child in self.tree.children(self.node):
+            yield self.tree.moves[self.tree.move[child]]
+
+    def __len__(self):
+        return sum(1 for child in self.tree.children(self.node))
+
+    def __bool__(self):
+        return self.tree.first_child[self.node] != NO_NODE
+
+    def items(self):
+        for child in self.tree.children(self.node):
+            yield self.tree.moves[self.tree.move[child]], TreeNodeView(self.tree, child)
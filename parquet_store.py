@@ -0,0 +1,298 @@
+import os
+import json
+import uuid
+import argparse
+from datetime import datetime
+from database import Db
+from games import GameDimensions
+from store_openings import insert_columns
+import tree_store
+from metrics import TREE_NODES
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+# Columnar copy of opening_moves, a hive partitioned Parquet dataset (month=/elo_bucket=/time_control_class=)
+PARQUET_DIR = os.getenv("PARQUET_DIR", "games_parquet")
+# Rows buffered before a write, so every partition gets a few large files instead of many small ones
+PARQUET_WRITE_ROWS = int(os.getenv("PARQUET_WRITE_ROWS", 500000))
+# Rows converted to Python objects at a time when reading games back
+PARQUET_READ_ROWS = int(os.getenv("PARQUET_READ_ROWS", 10000))
+
+PARTITION_COLUMNS = ["month", "elo_bucket", "time_control_class"]
+# Starts with an underscore so dataset discovery skips it
+VOCABULARY_FILE = "_moves.json"
+MAX_MOVE_IDS = 65536
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for Parquet datasets (pip install pyarrow)")
+
+
+def has_games(root=PARQUET_DIR):
+    return os.path.exists(os.path.join(root, VOCABULARY_FILE))
+
+
+# SAN moves of a dataset, moves are stored as their uint16 index in this list
+# The vocabulary only grows, so ids in existing files stay valid
+class MoveVocabulary:
+    def __init__(self, root=PARQUET_DIR):
+        self.path = os.path.join(root, VOCABULARY_FILE)
+        self.moves = list()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.moves = json.load(f)
+        self.ids = {move: move_id for move_id, move in enumerate(self.moves)}
+
+    def encode(self, moves):
+        move_ids = list()
+        for move in moves:
+            if move not in self.ids:
+                if len(self.moves) >= MAX_MOVE_IDS:
+                    raise ValueError(f"More than {MAX_MOVE_IDS} distinct moves, they don't fit in uint16 ids")
+                self.ids[move] = len(self.moves)
+                self.moves.append(move)
+            move_ids.append(self.ids[move])
+        return move_ids
+
+    def decode(self, move_ids):
+        return [self.moves[move_id] for move_id in move_ids]
+
+    # Replace the move ids column of a table by the moves as one space separated string per game, in Arrow
+    def decode_column(self, table, name="moves"):
+        moves = pa.array(self.moves, type=pa.string())
+        chunks = [pc.binary_join(pa.ListArray.from_arrays(chunk.offsets, moves.take(chunk.values)), " ")
+                  for chunk in table.column(name).chunks]
+        return table.set_column(table.schema.get_field_index(name), name, pa.chunked_array(chunks, pa.string()))
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.moves, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+# Writes (moves, elo, opening, time_control, pgn_id, game_id) rows, as produced by store_openings.parse_game,
+# to the partitioned dataset. Openings and time controls are dictionary encoded
+# Has the add_many/close interface of database.BulkInserter, so it can take an inserter's place
+# Games whose lichess game ID is already in their month partition are skipped like INSERT IGNORE skips them, so
+# an ingest can be resumed or restarted. Only the IDs stored before the writer was opened are checked: a writer
+# is fed every game once
+class GameWriter:
+    def __init__(self, root=PARQUET_DIR, write_rows=PARQUET_WRITE_ROWS):
+        require_pyarrow()
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.write_rows = write_rows
+        self.vocabulary = MoveVocabulary(root)
+        self.rows = list()
+        self.stored_ids = dict()  # Key: month, Value: sorted array of the game IDs stored in its partition
+
+    # Game IDs stored in a month partition when it was first looked at, read once per month
+    def month_ids(self, month):
+        if month not in self.stored_ids:
+            ids = list()
+            if os.path.isdir(os.path.join(self.root, f"month={month}")):
+                ids = read_table(self.root, ("game_id",), month=month).column("game_id").drop_null().to_pylist()
+            self.stored_ids[month] = np.sort(np.array(ids, dtype="S"))
+        return self.stored_ids[month]
+
+    def is_stored(self, game_id, month):
+        if game_id is None:
+            return False
+        ids = self.month_ids(month)
+        game_id = game_id.encode()
+        index = np.searchsorted(ids, game_id)
+        return index < len(ids) and ids[index] == game_id
+
+    def add_many(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.write_rows:
+            self.flush()
+
+    # Rows are written straight to their files, commit is accepted for BulkInserter compatibility
+    def flush(self, commit=False):
+        rows = [row for row in self.rows if not self.is_stored(row[5], row[4])]
+        if not rows:
+            self.rows = list()
+            return
+
+        moves, elos, openings, time_controls, pgn_ids, game_ids = zip(*rows)
+        table = pa.table({
+            "moves": pa.array([self.vocabulary.encode(game_moves.split()) for game_moves in moves],
+                              type=pa.list_(pa.uint16())),
+            "elo": pa.array(elos, type=pa.float32()),
+            "opening": pa.array(openings, type=pa.string()).dictionary_encode(),
+            "time_control": pa.array(time_controls, type=pa.string()).dictionary_encode(),
+            "pgn_id": pa.array(pgn_ids, type=pa.int32()),
+            "game_id": pa.array(game_ids, type=pa.string()),
+            "month": pa.array(pgn_ids, type=pa.int32()),
+            "elo_bucket": pa.array([tree_store.elo_bucket(elo) for elo in elos], type=pa.int16()),
+            "time_control_class": pa.array([tree_store.time_control_class(tc) for tc in time_controls]),
+        })
+
+        # The vocabulary is saved first, so every id in a written file can be decoded
+        self.vocabulary.save()
+        ds.write_dataset(table, self.root, format="parquet", partitioning=PARTITION_COLUMNS,
+                         partitioning_flavor="hive", existing_data_behavior="overwrite_or_ignore",
+                         basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet")
+        self.rows = list()
+
+    def close(self):
+        self.flush()
+        self.vocabulary.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Filter on the elo column, and on the elo_bucket, time_control_class and month partitions so whole directories
+# are skipped. The elo comparison is pushed down to the Parquet row group statistics
+def game_filter(min_elo=None, max_elo=None, time_control_classes=None, month=None):
+    expression = None
+    conditions = list()
+    if min_elo is not None:
+        conditions += [ds.field("elo_bucket") >= tree_store.elo_bucket(min_elo), ds.field("elo") >= min_elo]
+    if max_elo is not None:
+        conditions += [ds.field("elo_bucket") <= tree_store.elo_bucket(max_elo), ds.field("elo") <= max_elo]
+    if time_control_classes:
+        conditions.append(ds.field("time_control_class").isin(list(time_control_classes)))
+    if month is not None:
+        conditions.append(ds.field("month") == month)
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_table(root=PARQUET_DIR, columns=("moves", "opening"), min_elo=None, max_elo=None,
+               time_control_classes=None, month=None):
+    require_pyarrow()
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+    return dataset.to_table(columns=list(columns), filter=game_filter(min_elo, max_elo, time_control_classes, month))
+
+
+# Same games as games.stream_games, as a table of moves and opening sorted by moves
+# Games are decoded and sorted in Arrow, table_rows turns them into Python tuples a batch at a time
+def load_games(desired_elo=1500, elo_buffer=200, starting_moves="none", root=PARQUET_DIR):
+    table = read_table(root, ("moves", "opening"), desired_elo - elo_buffer, desired_elo + elo_buffer)
+    table = MoveVocabulary(root).decode_column(table)
+    # Case-insensitive like the moves LIKE 'prefix%' filter in MySQL
+    if starting_moves != "none":
+        table = table.filter(pc.starts_with(table.column("moves"), starting_moves, ignore_case=True))
+    return table.sort_by("moves")
+
+
+# Yield the rows of a table as tuples of its columns, PARQUET_READ_ROWS rows at a time
+def table_rows(table, read_rows=PARQUET_READ_ROWS):
+    for batch in table.to_batches(max_chunksize=read_rows):
+        yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+# Yield (moves, opening, elo, time_control) rows sorted by moves from a table of those columns with move ids
+def tree_rows(table, root=PARQUET_DIR):
+    table = MoveVocabulary(root).decode_column(table.select(["moves", "opening", "elo", "time_control"]))
+    yield from table_rows(table.sort_by("moves"))
+
+
+# (moves, opening, elo, time_control) rows with min_elo <= elo < max_elo sorted by moves, for tree_store.add_rows
+def load_rows(min_elo, max_elo, root=PARQUET_DIR):
+    table = read_table(root, ("moves", "opening", "elo", "time_control"), min_elo, max_elo)
+    return tree_rows(table.filter(ds.field("elo") < max_elo), root)
+
+
+# Same rows as load_rows for the games of one pgn_id, read from its month partitions only
+def pgn_rows(pgn_id, root=PARQUET_DIR):
+    return tree_rows(read_table(root, ("moves", "opening", "elo", "time_control"), month=pgn_id), root)
+
+
+# Copy opening_moves into the Parquet dataset
+def export_games(root=PARQUET_DIR):
+    DB = Db()
+    rows = DB.stream("SELECT moves, elo, openings.name, time_controls.name, pgn_id, game_id FROM opening_moves "
+                     "JOIN openings ON openings.id = opening_moves.opening_id "
+                     "JOIN time_controls ON time_controls.id = opening_moves.time_control_id")
+    game_count = 0
+    with GameWriter(root) as writer:
+        for row in rows:
+            writer.add_many([(row[0], float(row[1]), *row[2:])])
+            game_count += 1
+    DB.close_connection()
+    return game_count
+
+
+# Load the Parquet dataset (or the games in an elo range of it) into opening_moves
+def import_games(root=PARQUET_DIR, min_elo=None, max_elo=None):
+    require_pyarrow()
+    DB = Db()
+    dimensions = GameDimensions(DB)
+    vocabulary = MoveVocabulary(root)
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+
+    game_count = 0
+    for batch in dataset.to_batches(columns=["moves", "elo", "opening", "time_control", "pgn_id", "game_id"],
+                                    filter=game_filter(min_elo, max_elo)):
+        rows = [(" ".join(vocabulary.decode(move_ids)), *values)
+                for move_ids, *values in zip(*(column.to_pylist() for column in batch.columns))]
+        DB.load_data("opening_moves", insert_columns, dimensions.encode(rows))
+        game_count += len(rows)
+    DB.close_connection()
+    return game_count
+
+
+# Rebuild the elo bucket trees from the Parquet dataset instead of the database, see tree_store.build_buckets
+def build_buckets(root=PARQUET_DIR, tree_dir=tree_store.TREE_DIR):
+    os.makedirs(tree_dir, exist_ok=True)
+    buckets = read_table(root, ("elo_bucket",)).column("elo_bucket").unique().to_pylist()
+    for bucket in sorted(buckets):
+        trees = tree_store.add_rows(dict(), load_rows(bucket, bucket + tree_store.BUCKET_SIZE, root))
+        for (tc_class, tree_bucket), tree in trees.items():
+            tree.save(tree_store.bucket_path(tc_class, tree_bucket, tree_dir))
+        node_count = sum(len(tree) for tree in trees.values())
+        TREE_NODES.inc(node_count)
+        print(f"Built elo bucket {bucket}: {node_count} nodes")
+
+    months = read_table(root, ("month",)).column("month").value_counts().to_pylist()
+    tree_store.save_manifest({month["values"]: month["counts"] for month in months}, tree_dir)
+
+
+# Merge the months of the Parquet dataset that aren't in the trees yet (all of them by default),
+# see tree_store.update_pgn_ids
+def update_buckets(pgn_ids=None, root=PARQUET_DIR, tree_dir=tree_store.TREE_DIR):
+    if pgn_ids is None:
+        pgn_ids = read_table(root, ("month",)).column("month").unique().to_pylist()
+    return tree_store.update_pgn_ids(pgn_ids, lambda pgn_id: pgn_rows(pgn_id, root), tree_dir)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Export, import and build trees from the Parquet game dataset")
+    parser.add_argument("command", choices=["export", "import", "build-trees", "update-trees"])
+    parser.add_argument("--parquet-dir", default=PARQUET_DIR, help="directory of the Parquet dataset")
+    parser.add_argument("--tree-dir", default=tree_store.TREE_DIR, help="directory for the bucket tree files")
+    parser.add_argument("--min-elo", type=int, help="only import games with at least this elo")
+    parser.add_argument("--max-elo", type=int, help="only import games with at most this elo")
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    if args.command == "export":
+        print(f"exported {export_games(args.parquet_dir)} games")
+    elif args.command == "import":
+        print(f"imported {import_games(args.parquet_dir, args.min_elo, args.max_elo)} games")
+    elif args.command == "update-trees":
+        update_buckets(root=args.parquet_dir, tree_dir=args.tree_dir)
+    else:
+        build_buckets(args.parquet_dir, args.tree_dir)
+    end_time = datetime.now()
+
+    print(f"{args.command} runtime: {str(end_time - start_time)[:-3]}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,68 @@
+import chess
+import chess.polyglot
+from database import Db
+
+
+# 64-bit polyglot Zobrist key of a board, signed so it fits BIGINT and SQLite INTEGER columns
+# Move counters aren't part of the key, so transpositions reached on different move numbers share it
+def position_key(board):
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+def fen_key(fen):
+    return position_key(chess.Board(fen))
+
+
+# Replays a stream of games sorted by moves on one board, only undoing and playing the moves
+# that differ from the previous game instead of starting every game from a new board
+class PrefixReplay:
+    def __init__(self):
+        self.board = chess.Board()
+        self.moves = list()
+
+    # Undo moves until the board is on the longest common prefix with moves, returns the prefix length
+    def rewind(self, moves):
+        common = 0
+        limit = min(len(moves), len(self.moves))
+        while common < limit and moves[common] == self.moves[common]:
+            common += 1
+
+        for _ in range(len(self.moves) - common):
+            self.board.pop()
+        del self.moves[common:]
+        return common
+
+    def push(self, move):
+        self.board.push_san(move)
+        self.moves.append(move)
+
+    # Move the board to the position after moves, returns the number of moves that didn't have to be replayed
+    def play(self, moves):
+        common = self.rewind(moves)
+        for move in moves[common:]:
+            self.push(move)
+        return common
+
+
+# Fill in pos_key for evaluations stored before the column existed
+# The old fen_evaluations has no primary key and no index on fen, so instead of an UPDATE ... WHERE fen = ... per
+# row (a scan each), the keys are computed in one streamed pass, loaded into a table keyed by fen, and set with one
+# UPDATE joining it. FENs differ by case, so that key uses a binary collation. LOAD DATA LOCAL skips duplicate FENs
+def backfill_position_keys(DB):
+    DB.execute("DROP TABLE IF EXISTS fen_position_keys")
+    DB.execute("CREATE TABLE fen_position_keys "
+               "(fen VARCHAR(100) COLLATE utf8mb4_bin NOT NULL PRIMARY KEY, pos_key BIGINT NOT NULL)")
+    rows = DB.stream("SELECT fen FROM fen_evaluations WHERE pos_key IS NULL")
+    DB.load_data("fen_position_keys", ["fen", "pos_key"], ((fen, fen_key(fen)) for fen, in rows))
+    DB.execute("UPDATE fen_evaluations JOIN fen_position_keys ON fen_position_keys.fen = fen_evaluations.fen "
+               "SET fen_evaluations.pos_key = fen_position_keys.pos_key WHERE fen_evaluations.pos_key IS NULL")
+    updated = DB.execute("SELECT COUNT(*) AS count FROM fen_position_keys")[0]["count"]
+    DB.execute("DROP TABLE fen_position_keys")
+    print(f"Backfilled {updated} position keys")
+
+
+if __name__ == "__main__":
+    DB = Db()
+    backfill_position_keys(DB)
+    DB.close_connection()
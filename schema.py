@@ -0,0 +1,128 @@
+import os
+import re
+import sqlite3
+import argparse
+from database import Db, STORAGE_BACKEND
+from games import count_query, stream_query
+from positions import backfill_position_keys
+from tree_store import pgn_rows_query
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+migration_re = re.compile(r"^(\d{3})_\w+\.sql$")
+
+# Steps run before a migration is applied, as {migration name: function taking the connection}
+# 003 only keeps the evaluations that have a pos_key, so the keys of rows stored before 001 are filled in first
+BEFORE_MIGRATION = {"003_managed_schema": backfill_position_keys}
+
+# SQLite stand-in for the tables built by the migrations, used to check query plans without a MySQL server
+# Partitioning has no SQLite equivalent, the indexes are the same
+SQLITE_SCHEMA = """
+CREATE TABLE openings (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE time_controls (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE opening_moves (
+    id INTEGER PRIMARY KEY,
+    moves TEXT COLLATE NOCASE NOT NULL,
+    elo REAL NOT NULL,
+    opening_id INTEGER NOT NULL,
+    time_control_id INTEGER NOT NULL,
+    pgn_id INTEGER NOT NULL DEFAULT -1,
+    game_id TEXT
+);
+CREATE UNIQUE INDEX opening_moves_game_id ON opening_moves (game_id, elo);
+CREATE INDEX opening_moves_elo_moves ON opening_moves (elo, moves);
+CREATE INDEX opening_moves_moves_elo ON opening_moves (moves, elo);
+CREATE INDEX opening_moves_pgn_id ON opening_moves (pgn_id);
+CREATE TABLE fen_evaluations (pos_key INTEGER PRIMARY KEY, fen TEXT NOT NULL, evaluation REAL NOT NULL, depth INTEGER);
+"""
+
+
+# Migration files in the order they're applied, as (name, path)
+def list_migrations(migrations_dir=MIGRATIONS_DIR):
+    return [(filename[:-4], os.path.join(migrations_dir, filename))
+            for filename in sorted(os.listdir(migrations_dir)) if migration_re.match(filename)]
+
+
+# Apply every migration that hasn't been applied yet, recording each one in schema_migrations
+# baseline marks the migrations up to and including that number as applied without running them,
+# for databases whose tables were created or altered by hand
+def migrate(baseline=None, migrations_dir=MIGRATIONS_DIR):
+    if STORAGE_BACKEND != "mysql":
+        print("The embedded database creates its tables when it's opened, there is nothing to migrate")
+        return
+
+    DB = Db()
+    DB.execute("CREATE TABLE IF NOT EXISTS schema_migrations "
+               "(name VARCHAR(255) NOT NULL PRIMARY KEY, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    applied = {row["name"] for row in DB.execute("SELECT name FROM schema_migrations") or []}
+
+    for name, path in list_migrations(migrations_dir):
+        if name in applied:
+            continue
+        if baseline is None or int(name[:3]) > baseline:
+            if name in BEFORE_MIGRATION:
+                BEFORE_MIGRATION[name](DB)
+            print(f"Applying {name}...")
+            with open(path) as f:
+                DB.execute(f.read())
+        DB.execute("INSERT INTO schema_migrations (name) VALUES (%s)", (name,))
+
+    DB.close_connection()
+
+
+# Queries whose plans must use an index instead of scanning a whole table, as (description, query, arguments)
+def checked_queries():
+    queries = list()
+    for starting_moves in ("none", "e4 e5"):
+        queries.append((f"count_games, starting moves {starting_moves}", *count_query(1500, 200, starting_moves)))
+        queries.append((f"stream_games, starting moves {starting_moves}", *stream_query(1500, 200, starting_moves)))
+    queries.append(("tree update rows of a pgn_id", pgn_rows_query, (202106,)))
+    queries.append(("evaluation lookup",
+                    "SELECT pos_key, evaluation, depth FROM fen_evaluations WHERE pos_key IN (%s, %s)", (1, 2)))
+    return queries
+
+
+# Check the query plans of checked_queries against the SQLite stand-in, returns a list of problems
+def check_query_plans():
+    db = sqlite3.connect(":memory:")
+    db.executescript(SQLITE_SCHEMA)
+    # Some rows and statistics, so the planner picks plans like it would on real data
+    db.executemany("INSERT INTO opening_moves (moves, elo, opening_id, time_control_id, pgn_id) VALUES (?, ?, 1, 1, ?)",
+                   [(f"e4 e5 Nf3 {index}", 800 + index % 2000, 202101 + index % 12) for index in range(5000)])
+    db.execute("ANALYZE")
+
+    problems = list()
+    for description, query, arguments in checked_queries():
+        plan = [row[-1] for row in db.execute("EXPLAIN QUERY PLAN " + query.replace("%s", "?"), arguments)]
+        print(f"{description}:")
+        for step in plan:
+            print(f"    {step}")
+        for table in ("opening_moves", "fen_evaluations"):
+            if any(re.match(rf"SCAN {table}\b", step) for step in plan):
+                problems.append(f"{description} scans all of {table}")
+    db.close()
+    return problems
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Manage the chess_analysis schema")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="apply pending migrations")
+    migrate_parser.add_argument("--baseline", type=int,
+                                help="mark migrations up to this number as applied without running them")
+    subparsers.add_parser("check", help="check query plans against a SQLite stand-in")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        migrate(args.baseline)
+    else:
+        problems = check_query_plans()
+        for problem in problems:
+            print(f"Problem: {problem}")
+        if problems:
+            raise SystemExit(1)
+        print("All query plans use indexes")
+
+
+if __name__ == "__main__":
+    run()
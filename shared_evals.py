@@ -0,0 +1,168 @@
+import os
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+# Table configuration, overridable through environment variables
+# Slots are rounded up to a power of two, every slot takes 16 bytes (2M slots = 32 MB)
+SHARED_EVALS = os.getenv("SHARED_EVALS", "on")
+SHARED_EVAL_SLOTS = int(os.getenv("SHARED_EVAL_SLOTS", 1 << 21))
+# New positions are no longer tracked once the table is this full, so probe chains stay short
+SHARED_EVAL_MAX_LOAD = 0.75
+SHARED_EVAL_POLL_INTERVAL = 0.01
+
+# The block starts with a header word holding the number of used slots, followed by the keys and the values
+HEADER_WORDS = 1
+
+# Value word layout: centipawns (int16) | depth << 16 (uint16) | flags << 32. A slot with a value of 0 is free
+PENDING = 1
+DONE = 2
+NO_DEPTH = 0xFFFF
+CP_LIMIT = 32767
+# A slot key of 0 marks a free slot, so position key 0 is stored as ZERO_KEY. The two positions then share a slot
+# like any two positions whose Zobrist keys collide
+ZERO_KEY = -1
+
+
+def pack(pawns, depth, flags=DONE):
+    cp = min(max(round(pawns * 100), -CP_LIMIT), CP_LIMIT)
+    return (cp & 0xFFFF) | ((NO_DEPTH if depth is None else min(depth, NO_DEPTH - 1)) << 16) | (flags << 32)
+
+
+# Returns (pawns, depth)
+def unpack(word):
+    cp = word & 0xFFFF
+    depth = (word >> 16) & 0xFFFF
+    return (cp - 0x10000 if cp > CP_LIMIT else cp) / 100, None if depth == NO_DEPTH else depth
+
+
+# Evaluations shared by a process and its worker processes through one shared memory block
+# An open-addressing hash table (linear probing) of position key -> (centipawns, depth, flags), as two arrays of
+# 64-bit words after a header word. Slots are never moved or removed, and the key of a slot is written before its
+# value, so readers probe without a lock: an aligned 64-bit store is atomic, a reader sees either the old or the
+# new value word. Writers take the lock. Positions are claimed (PENDING) before they're evaluated, and other
+# processes wait for a claimed position instead of evaluating it again
+# The used slot count lives in the header, so every attached process sees the same count and the table never
+# fills past SHARED_EVAL_MAX_LOAD
+class SharedEvalTable:
+    def __init__(self, slots=SHARED_EVAL_SLOTS, name=None, lock=None):
+        self.slots = 1 << max(int(slots) - 1, 1).bit_length()
+        self.mask = self.slots - 1
+        self.owner = name is None
+        size = (HEADER_WORDS + self.slots * 2) * 8
+        if self.owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._shm.buf[:size] = bytes(size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.lock = lock or multiprocessing.Lock()
+        self.header = np.ndarray(HEADER_WORDS, dtype=np.uint64, buffer=self._shm.buf)
+        self.keys = np.ndarray(self.slots, dtype=np.int64, buffer=self._shm.buf, offset=HEADER_WORDS * 8)
+        self.values = np.ndarray(self.slots, dtype=np.uint64, buffer=self._shm.buf,
+                                 offset=(HEADER_WORDS + self.slots) * 8)
+        self.max_used = int(self.slots * SHARED_EVAL_MAX_LOAD)
+
+    # Everything a worker process needs to attach, pass it as Pool initargs (the lock can't be pickled later)
+    def handle(self):
+        return self.slots, self._shm.name, self.lock
+
+    @classmethod
+    def attach(cls, slots, name, lock):
+        return cls(slots, name, lock)
+
+    # Slot holding key, or the free slot where it would go, None if every slot was probed without finding either
+    # Returns (slot, whether the slot holds key)
+    def _find(self, key):
+        key = key or ZERO_KEY
+        slot = key & self.mask
+        for _ in range(self.slots):
+            slot_key = int(self.keys[slot])
+            if slot_key == key:
+                return slot, True
+            if slot_key == 0 and not self.values[slot]:
+                return slot, False
+            slot = (slot + 1) & self.mask
+        return None, False
+
+    # Take a free slot for key, with the lock held. Returns False once the table is full
+    def _insert(self, slot, key):
+        if slot is None or int(self.header[0]) >= self.max_used:
+            return False
+        self.keys[slot] = key or ZERO_KEY
+        self.header[0] += np.uint64(1)
+        return True
+
+    # Lock-free lookup, returns {position key: (eval in pawns, depth)} of the evaluated positions
+    def get_many(self, keys):
+        found = dict()
+        for key in keys:
+            slot, stored = self._find(key)
+            if stored:
+                word = int(self.values[slot])
+                if (word >> 32) & DONE:
+                    found[key] = unpack(word)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    # Claim the positions nobody has claimed yet, returns the keys the caller should evaluate
+    # Positions that don't fit in the table any more are always returned, they're evaluated untracked
+    def claim(self, keys):
+        claimed = list()
+        with self.lock:
+            for key in keys:
+                slot, stored = self._find(key)
+                if stored:
+                    if self.values[slot]:
+                        continue
+                elif not self._insert(slot, key):
+                    claimed.append(key)
+                    continue
+                self.values[slot] = np.uint64(PENDING << 32)
+                claimed.append(key)
+        return claimed
+
+    # Store evaluations, as {position key: (eval in pawns, depth)}
+    def put_many(self, evals):
+        with self.lock:
+            for key, (pawns, depth) in evals.items():
+                slot, stored = self._find(key)
+                if not stored and not self._insert(slot, key):
+                    continue
+                self.values[slot] = np.uint64(pack(pawns, depth))
+
+    def put(self, key, pawns, depth=None):
+        self.put_many({key: (pawns, depth)})
+
+    # Give up claims that won't be evaluated, e.g. after an engine error, so another process can take them
+    def release(self, keys):
+        with self.lock:
+            for key in keys:
+                slot, stored = self._find(key)
+                if stored and int(self.values[slot]) >> 32 == PENDING:
+                    self.values[slot] = np.uint64(0)
+
+    # Wait for positions claimed by other processes, until every one is evaluated or claimed by the caller
+    # Returns ({position key: (eval in pawns, depth)}, claimed keys). Positions whose claim was released are
+    # claimed by the caller, who must evaluate them
+    def wait(self, keys, poll_interval=SHARED_EVAL_POLL_INTERVAL):
+        keys = list(keys)
+        found = dict()
+        claimed = set()
+        while True:
+            found.update(self.get_many(key for key in keys if key not in found and key not in claimed))
+            waiting = [key for key in keys if key not in found and key not in claimed]
+            if not waiting:
+                return found, claimed
+            newly_claimed = self.claim(waiting)
+            claimed.update(newly_claimed)
+            if len(newly_claimed) < len(waiting):
+                time.sleep(poll_interval)
+
+    def close(self):
+        del self.header, self.keys, self.values
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
@@ -1,6 +1,35 @@
+import os
+import math
+import time
+import atexit
+import multiprocessing
+import chess
+import chess.engine
 from stockfish import Stockfish
+from metrics import ENGINE_EVALS, ENGINE_EVAL_SECONDS
+from positions import fen_key
+from shared_evals import SHARED_EVALS, SharedEvalTable
 
-stockfish = Stockfish(r"C:\\Program Files\\stockfish_14_win_x64_avx2\\stockfish_14_x64_avx2.exe", parameters={
+# Engine configuration, overridable through environment variables
+STOCKFISH_PATH = os.getenv("STOCKFISH_PATH", r"C:\\Program Files\\stockfish_14_win_x64_avx2\\stockfish_14_x64_avx2.exe")
+STOCKFISH_DEPTH = int(os.getenv("STOCKFISH_DEPTH", 20))
+STOCKFISH_WORKERS = int(os.getenv("STOCKFISH_WORKERS", os.cpu_count() or 1))
+
+# "fixed" searches every position to STOCKFISH_DEPTH, "adaptive" starts at STOCKFISH_MIN_DEPTH and only
+# deepens (by STOCKFISH_DEPTH_STEP, up to STOCKFISH_DEPTH) while the eval is close to a decision threshold
+# "multipv" evaluates the children of an opening tree node with one search of the node (see uci_engine)
+EVAL_MODE = os.getenv("EVAL_MODE", "fixed")
+STOCKFISH_MIN_DEPTH = int(os.getenv("STOCKFISH_MIN_DEPTH", 10))
+STOCKFISH_DEPTH_STEP = int(os.getenv("STOCKFISH_DEPTH_STEP", 4))
+# Per position budget of the adaptive mode, 0 for no limit
+STOCKFISH_NODES = int(os.getenv("STOCKFISH_NODES", 0))
+STOCKFISH_TIME = float(os.getenv("STOCKFISH_TIME", 0))
+
+# Evals (in pawns) where blunder decisions flip, see blunder_scoring: the +0.5/0 blunder limits and +/-1 advantage
+DECISION_THRESHOLDS = (-1, 0, 0.5, 1)
+DECISION_MARGIN = float(os.getenv("DECISION_MARGIN", 0.15))
+
+engine_parameters = {
     "Write Debug Log": "false",
     "Contempt": 0,
     "Min Split Depth": 0,
@@ -13,11 +42,199 @@ stockfish = Stockfish(r"C:\\Program Files\\stockfish_14_win_x64_avx2\\stockfish_
     "Minimum Thinking Time": 20,
     "Slow Mover": 80,
     "UCI_Chess960": "false",
-})
-stockfish.set_depth(20)
+}
+
+# Engines used by get_stockfish_eval and get_adaptive_eval, started on first use
+stockfish = None
+uci_engine = None
+# Evaluation table shared with the other pool processes, attached in _init_worker
+shared_table = None
+
+
+def create_engine(threads=2):
+    engine = Stockfish(STOCKFISH_PATH, parameters=dict(engine_parameters, Threads=threads))
+    engine.set_depth(STOCKFISH_DEPTH)
+    return engine
 
 
 def get_stockfish_eval(fen):
+    global stockfish
+    if stockfish is None:
+        stockfish = create_engine()
+
     stockfish.set_fen_position(fen)
     eval = stockfish.get_evaluation()
     return eval
+
+
+# engine_parameters as the options of a python-chess UCI engine. Options python-chess sets per search (MultiPV,
+# Ponder, UCI_Chess960) can't be configured, and options this Stockfish version doesn't have are left out, like
+# the engine ignores them when the stockfish package sends them
+def uci_options(engine, threads):
+    return {name: value for name, value in dict(engine_parameters, Threads=threads).items()
+            if name in engine.options and not engine.options[name].is_managed()}
+
+
+def create_uci_engine(threads=2):
+    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    engine.configure(uci_options(engine, threads))
+    atexit.register(engine.quit)
+    return engine
+
+
+# Convert a python-chess score to the {"type": ..., "value": ...} dict returned by the stockfish package
+def score_to_eval(score):
+    score = score.white()
+    if score.is_mate():
+        return {"type": "mate", "value": score.mate()}
+    return {"type": "cp", "value": score.score()}
+
+
+# Evaluate a position shallow first, and search deeper only while the eval is within margin of a threshold
+# nodes and time_limit (seconds) are a budget for the position across all iterations, 0 for no limit
+# The engine keeps its hash between iterations, so each deeper search mostly reuses the previous one
+# Returns (eval, depth reached)
+def get_adaptive_eval(fen, thresholds=DECISION_THRESHOLDS, margin=DECISION_MARGIN, nodes=STOCKFISH_NODES,
+                      time_limit=STOCKFISH_TIME):
+    global uci_engine
+    if uci_engine is None:
+        uci_engine = create_uci_engine()
+
+    board = chess.Board(fen)
+    depth = min(STOCKFISH_MIN_DEPTH, STOCKFISH_DEPTH)
+    nodes_left, time_left = nodes, time_limit
+    while True:
+        info = uci_engine.analyse(board, chess.engine.Limit(depth=depth, nodes=nodes_left or None,
+                                                            time=time_left or None))
+        eval = score_to_eval(info["score"])
+        nodes_left -= info.get("nodes", 0) if nodes else 0
+        time_left -= info.get("time", 0) if time_limit else 0
+
+        # Done once the eval is clear of every threshold, at full depth or out of budget
+        pawns = eval_to_pawns(eval)
+        if (eval["type"] == "mate" or all(abs(pawns - threshold) > margin for threshold in thresholds) or
+                depth >= STOCKFISH_DEPTH or (nodes and nodes_left <= 0) or (time_limit and time_left <= 0)):
+            return eval, info.get("depth", depth)
+        depth = min(depth + STOCKFISH_DEPTH_STEP, STOCKFISH_DEPTH)
+
+
+# Evaluate a position with the configured EVAL_MODE, returns (eval, depth)
+def evaluate(fen):
+    if EVAL_MODE == "adaptive":
+        return get_adaptive_eval(fen)
+    return get_stockfish_eval(fen), STOCKFISH_DEPTH
+
+
+# Convert a stockfish evaluation to pawns, with mates clamped to +/- mate_eval
+def eval_to_pawns(eval, mate_eval=5):
+    if eval["type"] == "cp":
+        return round(eval["value"] * 0.01, 2)
+    return math.copysign(mate_eval, eval["value"])
+
+
+# Each pool process owns a single-threaded engine, so N workers use N cores
+def _init_worker(table_handle=None):
+    global stockfish, uci_engine, shared_table
+    if EVAL_MODE == "adaptive":
+        uci_engine = create_uci_engine(threads=1)
+    else:
+        stockfish = create_engine(threads=1)
+    if table_handle:
+        shared_table = SharedEvalTable.attach(*table_handle)
+
+
+# Returns (fen, eval, depth, seconds), the time is recorded in the metrics of the parent process
+# With a shared table, a position another process has claimed is waited for instead of evaluated again,
+# and comes back as a centipawn eval with seconds None
+def _evaluate_worker(fen):
+    start = time.perf_counter()
+    if shared_table is None:
+        eval, depth = evaluate(fen)
+        return fen, eval, depth, time.perf_counter() - start
+
+    key = fen_key(fen)
+    if not shared_table.claim([key]):
+        stored = shared_table.wait([key])[0]
+        if key in stored:
+            pawns, depth = stored[key]
+            return fen, {"type": "cp", "value": round(pawns * 100)}, depth, None
+    try:
+        eval, depth = evaluate(fen)
+    except BaseException:
+        shared_table.release([key])
+        raise
+    shared_table.put(key, eval_to_pawns(eval), depth)
+    return fen, eval, depth, time.perf_counter() - start
+
+
+def _record_eval(result):
+    fen, eval, depth, seconds = result
+    if seconds is not None:
+        ENGINE_EVALS.inc()
+        ENGINE_EVAL_SECONDS.observe(seconds)
+    return fen, eval, depth
+
+
+# Pool processes share one SharedEvalTable (unless SHARED_EVALS is "off"), so evaluations are held once for
+# all of them and a position is never searched by two engines
+class EnginePool:
+    def __init__(self, workers=STOCKFISH_WORKERS):
+        self.workers = max(1, workers)
+        self._pool = None
+        self.table = None
+
+    # Evaluate positions across the pool, yielding (fen, eval, depth) tuples as each one finishes
+    def evaluate_many(self, fens):
+        fens = list(dict.fromkeys(fens))
+        if not fens:
+            return
+
+        # Not worth starting processes for a single position
+        if self.workers == 1 or len(fens) == 1:
+            for fen in fens:
+                yield _record_eval(_evaluate_worker(fen))
+            return
+
+        if self._pool is None:
+            if SHARED_EVALS == "on":
+                self.table = SharedEvalTable()
+            self._pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                              initargs=(self.table.handle() if self.table else None,))
+
+        # Positions the pool already evaluated don't need a worker
+        if self.table:
+            keys = {fen: fen_key(fen) for fen in fens}
+            stored = self.table.get_many(keys.values())
+            for fen in [fen for fen in fens if keys[fen] in stored]:
+                pawns, depth = stored[keys[fen]]
+                yield fen, {"type": "cp", "value": round(pawns * 100)}, depth
+            fens = [fen for fen in fens if keys[fen] not in stored]
+
+        for result in self._pool.imap_unordered(_evaluate_worker, fens):
+            yield _record_eval(result)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+
+
+# Pool shared by everything in this process, started on first use
+engine_pool = None
+
+
+def get_engine_pool():
+    global engine_pool
+    if engine_pool is None:
+        engine_pool = EnginePool()
+        atexit.register(engine_pool.close)
+    return engine_pool
+
+
+# Evaluate a batch of FENs in parallel, yielding (fen, eval, depth) tuples in completion order
+def evaluate_many(fens):
+    return get_engine_pool().evaluate_many(fens)
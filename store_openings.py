@@ -1,61 +1,145 @@
+import re
 import sys
 from datetime import datetime
 import chess
 from database import Db
+from games import GameDimensions
+from metrics import GAMES_PARSED, stage
 
 import pprint
 
-def store_opening_moves(pgn, pgn_id=-1):
-    # Connect to database
-    DB = Db()
-    DB.execute("USE chess_analysis")
+insert_columns = ("moves", "elo", "opening_id", "time_control_id", "pgn_id", "game_id")
+# Games that are already stored (same lichess game ID) are skipped
+insert_query = f"INSERT IGNORE INTO opening_moves ({', '.join(insert_columns)}) VALUES ({', '.join(['%s'] * len(insert_columns))})"
+
+# Number of half moves stored per game
+max_moves = 40
+
+# PGN header line, e.g. [WhiteElo "1500"]
+header_re = re.compile(rb'^\[(\w+)\s+"(.*)"\]')
+# Site header of a lichess game, e.g. https://lichess.org/AbCdEfGh
+lichess_site_re = re.compile(r'^https?://lichess\.org/(\w{8})')
+# Comments ({ [%clk 0:05:00] }, { [%eval 0.3] }) and variations in movetext
+comment_re = re.compile(r'\{[^}]*\}|;[^\n]*')
+variation_re = re.compile(r'\([^()]*\)')
+# Movetext tokens that aren't moves: move numbers, NAGs and results
+non_move_re = re.compile(r'^(\d+\.+|\$\d+|1-0|0-1|1/2-1/2|\*)$')
+move_number_re = re.compile(r'^\d+\.+')
+annotation_re = re.compile(r'[!?]+$')
+
+
+# Scan PGN byte lines without building game trees, yields (headers, movetext bytes) for every game
+# Header values are decoded, the movetext is left as raw bytes until it's needed
+def scan_games(lines):
+    headers, movetext = dict(), list()
+    for line in lines:
+        if line.startswith(b"["):
+            if movetext:
+                yield headers, b" ".join(movetext)
+                headers, movetext = dict(), list()
+            match = header_re.match(line)
+            if match:
+                headers[match.group(1).decode()] = match.group(2).decode("utf-8", errors="replace")
+        elif line.strip():
+            movetext.append(line.strip())
 
-    # Read through all chess games in the pgn
-    while True:
-        game = chess.pgn.read_game(pgn)
+    if headers:
+        yield headers, b" ".join(movetext)
 
-        # Exit when there are no more games
-        if game == None:
+
+# Pull the first max_moves SAN moves out of movetext, skipping comments, variations, move numbers and NAGs
+def san_moves(movetext, limit=max_moves):
+    movetext = comment_re.sub(" ", movetext.decode("utf-8", errors="replace"))
+    while "(" in movetext:
+        stripped = variation_re.sub(" ", movetext)
+        if stripped == movetext:
             break
+        movetext = stripped
+
+    moves = list()
+    for token in movetext.split():
+        if non_move_re.match(token):
+            continue
+        token = annotation_re.sub("", move_number_re.sub("", token))
+        if token:
+            moves.append(token)
+            if len(moves) >= limit:
+                break
+    return moves
+
+
+# lichess game ID of a game, None for games that weren't played on lichess
+def lichess_game_id(headers):
+    match = lichess_site_re.match(headers.get("Site", ""))
+    return match.group(1) if match else None
 
-        # Get average elo of players
+
+# Turn a scanned game into an opening_moves row, or None if the game should be skipped
+# With validate=True the moves are replayed on a board, so illegal or non-standard SAN is rejected and normalised
+def parse_game(headers, movetext, pgn_id=-1, min_elo=None, max_elo=None, validate=False):
+    # Get average elo of players, skip the game before doing any move work if it's outside the filter
+    try:
+        elo = (int(headers["WhiteElo"]) +
+               int(headers["BlackElo"])) / 2
+    except (KeyError, ValueError):
+        return None
+    if (min_elo is not None and elo < min_elo) or (max_elo is not None and elo > max_elo):
+        return None
+
+    game_moves = san_moves(movetext)
+    if validate:
+        board = chess.Board()
+        validated_moves = list()
         try:
-            elo = (int(game.headers["WhiteElo"]) +
-                   int(game.headers["BlackElo"])) / 2
+            for move in game_moves:
+                move = board.parse_san(move)
+                validated_moves.append(board.san(move))
+                board.push(move)
         except ValueError:
-            continue
+            return None
+        game_moves = validated_moves
+    game_moves = " ".join(game_moves)
 
-        # Play through each move and store the first 20 as a string
-        board = game.board()
-        game_moves = list()
-        for index, move in enumerate(game.mainline_moves()):
-            if index >= 40:
-                continue
-            game_moves.append(board.san(move))
-            board.push(move)
-        game_moves = " ".join(game_moves)
+    # Get game opening and time control
+    opening = headers["Opening"]
+    time_control = headers["TimeControl"]
+
+    return (game_moves, elo, opening, time_control, pgn_id, lichess_game_id(headers))
 
-        # Get game opening and time control
-        opening = game.headers["Opening"]
-        time_control = game.headers["TimeControl"]
 
-        # Store first 20 moves of each game in database
-        DB.execute("INSERT INTO opening_moves (moves, elo, opening, time_control, pgn_id) VALUES (%s, %s, %s, %s, %s)",
-                   (game_moves, elo, opening, time_control, pgn_id))
+def store_opening_moves(pgn, pgn_id=-1, validate=False):
+    # Connect to database
+    DB = Db()
+
+    # Read through all chess games in the pgn and store the first 20 moves of each game in batches
+    dimensions = GameDimensions(DB)
+    with DB.bulk_inserter(insert_query) as inserter:
+        for headers, movetext in scan_games(pgn):
+            GAMES_PARSED.inc()
+            row = parse_game(headers, movetext, pgn_id, validate=validate)
+            if row is None:
+                continue
+
+            inserter.add_many(dimensions.encode([row]))
 
     # Close database connection
     DB.close_connection()
 
 
 def run():
-    pgn = sys.stdin
+    pgn = sys.stdin.buffer
+    validate = "--validate" in sys.argv[1:]
+    # pgn_id of the games, e.g. --pgn-id 202106 for the June 2021 dump, so tree_store.py --update can merge them
+    pgn_id = int(sys.argv[sys.argv.index("--pgn-id") + 1]) if "--pgn-id" in sys.argv[1:] else -1
 
     start_time = datetime.now()
-    store_opening_moves(pgn)
+    with stage("store_opening_moves"):
+        store_opening_moves(pgn, pgn_id, validate=validate)
     end_time = datetime.now()
 
     print(
         f"store_opening_moves runtime: {str(end_time - start_time)[:-3]}")
 
 
-run()
+if __name__ == "__main__":
+    run()
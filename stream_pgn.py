@@ -4,25 +4,80 @@ import pprint
 
 import sys
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 filename = 'temp.file'
+default_url = 'https://database.lichess.org/standard/lichess_db_standard_rated_2013-01.pgn.bz2'
+chunk_size = 16384
 
 
 def decompression(qin,                 # Iterable supplying input bytes data
                   qout):               # Pipe to next process - needs bytes data
+    for dc in decompress_chunks(qin):
+        qout.write(dc)
+
+
+# Generator version of decompression, yields decompressed chunks of a (possibly multi-stream) bz2 file
+def decompress_chunks(qin):
     decomp = bz2.BZ2Decompressor()     # Create a decompressor
     for chunk in qin:                  # Loop obtaining data from source iterable
         dc = decomp.decompress(chunk)  # Do the decompression
-        qout.write(dc)
+        yield dc
         while decomp.eof:
             remaining_data = decomp.unused_data
             decomp = bz2.BZ2Decompressor()
             dc = decomp.decompress(remaining_data)
-            qout.write(dc)
-        # qout.put(dc)                   # Pass the decompressed chunk to the next process
+            yield dc
+
+
+def decompress_zst_chunks(qin):
+    if zstandard is None:
+        raise ImportError("zstandard is required to read .zst files (pip install zstandard)")
+    decomp = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in qin:
+        yield decomp.decompress(chunk)
+
+
+# Drop the first offset bytes of a stream of chunks
+def skip_bytes(chunks, offset):
+    for chunk in chunks:
+        if offset >= len(chunk):
+            offset -= len(chunk)
+            continue
+        yield chunk[offset:]
+        offset = 0
+
+
+# Open a lichess dump by URL or local path and yield its decompressed bytes, starting offset bytes in
+# Uncompressed local files seek to the offset, anything else has to be decompressed up to it
+def stream_source(source, offset=0):
+    remote = source.startswith(("http://", "https://"))
+    compressed = source.endswith(('.bz2', '.zst'))
+    if remote:
+        f = urllib.request.urlopen(source)
+    else:
+        f = open(source, 'rb')
+
+    with f:
+        if offset and not remote and not compressed:
+            f.seek(offset)
+            offset = 0
+        it = iter(lambda: f.read(chunk_size), b'')
+        if source.endswith('.bz2'):
+            chunks = decompress_chunks(it)
+        elif source.endswith('.zst'):
+            chunks = decompress_zst_chunks(it)
+        else:
+            chunks = it
+        yield from skip_bytes(chunks, offset)
 
 
-req = urllib.request.urlopen(
-    'https://database.lichess.org/standard/lichess_db_standard_rated_2013-01.pgn.bz2')
-it = iter(lambda: req.read(16384), b'')
+if __name__ == "__main__":
+    url = sys.argv[1] if len(sys.argv) > 1 else default_url
+    req = urllib.request.urlopen(url)
+    it = iter(lambda: req.read(chunk_size), b'')
 
-decompression(it, sys.stdout.buffer)
+    decompression(it, sys.stdout.buffer)
@@ -0,0 +1,34 @@
+import ingest
+import parquet_store
+
+
+def write_pgn(path, games):
+    with open(path, "w") as f:
+        for index in range(games):
+            f.write(f'[Event "Rated game"]\n[Site "https://lichess.org/{index:08d}"]\n[WhiteElo "{1000 + index}"]\n'
+                    f'[BlackElo "1500"]\n[TimeControl "180+0"]\n[Opening "Test"]\n\n1. e4 e5 2. Nf3 Nc6 *\n\n')
+
+
+def stored_games(root):
+    table = parquet_store.read_table(str(root), ("game_id",))
+    return table.num_rows, len(table.column("game_id").unique())
+
+
+# Batches after the last checkpoint are ingested again on a resume, their games must not be stored twice
+def test_parquet_ingest_resume_skips_stored_games(tmp_path):
+    source = str(tmp_path / "lichess_db_standard_rated_2021-01.pgn")
+    write_pgn(source, 300)
+    root = tmp_path / "games"
+
+    ingest.ingest([source], workers=1, files=1, parquet_dir=str(root))
+    assert stored_games(root) == (300, 300)
+
+    # Resume from the start of the source, as if no checkpoint had been saved
+    progress = ingest.IngestProgress(str(root / "_ingest_progress.sqlite"))
+    progress.reset([source])
+    progress.close()
+    ingest.ingest([source], workers=1, files=1, parquet_dir=str(root))
+    assert stored_games(root) == (300, 300)
+
+    ingest.ingest([source], workers=1, files=1, parquet_dir=str(root), restart=True)
+    assert stored_games(root) == (300, 300)
@@ -0,0 +1,6 @@
+import schema
+
+
+# The queries of checked_queries must use an index on the SQLite stand-in of the migrated schema
+def test_query_plans_use_indexes():
+    assert schema.check_query_plans() == []
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+from datetime import datetime
+from database import Db
+from opening_tree import OpeningTree
+from metrics import TREE_NODES, stage
+
+# Persisted opening trees, one per elo bucket and time control class
+TREE_DIR = os.getenv("TREE_DIR", "trees")
+BUCKET_SIZE = 100
+# Games of every pgn_id (month) merged into the trees, so new months are merged in once and only once
+MANIFEST_FILE = "manifest.json"
+TIME_CONTROL_CLASSES = ("ultrabullet", "bullet", "blitz", "rapid", "classical", "correspondence")
+
+tree_file_re = re.compile(r"^(\w+)_(\d+)\.tree$")
+
+
+def elo_bucket(elo):
+    return int(elo // BUCKET_SIZE) * BUCKET_SIZE
+
+
+# Lichess time control class, based on the estimated game duration of base + 40 * increment seconds
+def time_control_class(time_control):
+    try:
+        base, increment = time_control.split("+")
+        duration = int(base) + 40 * int(increment)
+    except ValueError:
+        return "correspondence"
+
+    if duration < 30:
+        return "ultrabullet"
+    if duration < 180:
+        return "bullet"
+    if duration < 480:
+        return "blitz"
+    if duration < 1500:
+        return "rapid"
+    return "classical"
+
+
+def bucket_path(tc_class, bucket, tree_dir=TREE_DIR):
+    return os.path.join(tree_dir, f"{tc_class}_{bucket}.tree")
+
+
+# All persisted buckets as {(time control class, bucket): path}
+def list_buckets(tree_dir=TREE_DIR):
+    buckets = dict()
+    if os.path.isdir(tree_dir):
+        for filename in os.listdir(tree_dir):
+            match = tree_file_re.match(filename)
+            if match:
+                buckets[(match.group(1), int(match.group(2)))] = os.path.join(tree_dir, filename)
+    return buckets
+
+
+# Merged games per pgn_id, as {pgn_id: number of games}
+def load_manifest(tree_dir=TREE_DIR):
+    path = os.path.join(tree_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as f:
+        return {int(pgn_id): games for pgn_id, games in json.load(f)["pgn_ids"].items()}
+
+
+def save_manifest(manifest, tree_dir=TREE_DIR):
+    path = os.path.join(tree_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"pgn_ids": {str(pgn_id): games for pgn_id, games in sorted(manifest.items())}}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+# Add (moves, opening, elo, time_control) rows to per-bucket trees, creating trees as needed
+def add_rows(trees, rows):
+    for moves, opening, elo, time_control in rows:
+        key = (time_control_class(time_control), elo_bucket(elo))
+        if key not in trees:
+            trees[key] = OpeningTree()
+        trees[key].add_game(moves.split(), opening)
+    return trees
+
+
+# Yield (moves, opening, elo, time_control) rows of the games with min_elo <= elo < max_elo, sorted by moves
+def stream_rows(DB, min_elo, max_elo):
+    yield from DB.stream("SELECT moves, openings.name, elo, time_controls.name FROM opening_moves "
+                         "JOIN openings ON openings.id = opening_moves.opening_id "
+                         "JOIN time_controls ON time_controls.id = opening_moves.time_control_id "
+                         "WHERE elo >= %s AND elo < %s ORDER BY moves", (min_elo, max_elo))
+
+
+# Same rows as stream_rows for the games of one pgn_id
+pgn_rows_query = ("SELECT moves, openings.name, elo, time_controls.name FROM opening_moves "
+                  "JOIN openings ON openings.id = opening_moves.opening_id "
+                  "JOIN time_controls ON time_controls.id = opening_moves.time_control_id "
+                  "WHERE pgn_id = %s ORDER BY moves")
+
+
+def pgn_rows(DB, pgn_id):
+    yield from DB.stream(pgn_rows_query, (pgn_id,))
+
+
+# Offline build step: rebuild every bucket tree from opening_moves, one elo bucket at a time
+def build_buckets(tree_dir=TREE_DIR):
+    DB = Db()
+    os.makedirs(tree_dir, exist_ok=True)
+
+    elo_range = DB.execute("SELECT MIN(elo) AS min_elo, MAX(elo) AS max_elo FROM opening_moves")[0]
+    if elo_range["min_elo"] is None:
+        DB.close_connection()
+        return
+
+    for bucket in range(elo_bucket(elo_range["min_elo"]), int(elo_range["max_elo"]) + 1, BUCKET_SIZE):
+        trees = add_rows(dict(), stream_rows(DB, bucket, bucket + BUCKET_SIZE))
+        for (tc_class, tree_bucket), tree in trees.items():
+            tree.save(bucket_path(tc_class, tree_bucket, tree_dir))
+        node_count = sum(len(tree) for tree in trees.values())
+        TREE_NODES.inc(node_count)
+        print(f"Built elo bucket {bucket}: {node_count} nodes")
+
+    save_manifest({row["pgn_id"]: row["games"] for row in
+                   DB.execute("SELECT pgn_id, COUNT(*) AS games FROM opening_moves GROUP BY pgn_id")}, tree_dir)
+    DB.close_connection()
+
+
+# Merge newly ingested games into the persisted bucket trees
+# delta_trees are per-bucket trees of the new games only, as built by add_rows
+def update_buckets(delta_trees, tree_dir=TREE_DIR):
+    os.makedirs(tree_dir, exist_ok=True)
+    for (tc_class, bucket), delta in delta_trees.items():
+        path = bucket_path(tc_class, bucket, tree_dir)
+        tree = OpeningTree.load(path) if os.path.exists(path) else OpeningTree()
+        tree.merge(delta)
+        tree.save(path)
+
+
+# Merge the games of pgn_ids that aren't in the trees yet, one pgn_id at a time, so keeping the trees current
+# costs time proportional to the new games. pgn_rows(pgn_id) yields the (moves, opening, elo, time_control) rows
+# of a pgn_id. Games without a pgn_id (-1) can't be told apart from the ones already merged, only a full
+# rebuild picks them up. Returns the keys of the changed buckets
+def update_pgn_ids(pgn_ids, pgn_rows, tree_dir=TREE_DIR):
+    os.makedirs(tree_dir, exist_ok=True)
+    manifest = load_manifest(tree_dir)
+    changed = set()
+    for pgn_id in sorted(set(pgn_ids) - manifest.keys() - {-1}):
+        delta_trees = add_rows(dict(), pgn_rows(pgn_id))
+        update_buckets(delta_trees, tree_dir)
+        TREE_NODES.inc(sum(len(tree) for tree in delta_trees.values()))
+        changed.update(delta_trees)
+
+        manifest[pgn_id] = sum(int(tree.count[0]) for tree in delta_trees.values())
+        save_manifest(manifest, tree_dir)
+        print(f"Merged pgn_id {pgn_id}: {manifest[pgn_id]} games into {len(delta_trees)} buckets")
+    return changed
+
+
+# Merge the pgn_ids of opening_moves that aren't in the trees yet (all of them by default), see update_pgn_ids
+def update_from_db(pgn_ids=None, tree_dir=TREE_DIR):
+    DB = Db()
+    if pgn_ids is None:
+        pgn_ids = [row["pgn_id"] for row in DB.execute("SELECT DISTINCT pgn_id FROM opening_moves")]
+    changed = update_pgn_ids(pgn_ids, lambda pgn_id: pgn_rows(DB, pgn_id), tree_dir)
+    DB.close_connection()
+    return changed
+
+
+# Keys of the buckets covering desired_elo +/- elo_buffer, out of (time control class, bucket) keys
+# The window is rounded to whole buckets: every bucket starting inside [min elo, max elo) is used
+def window_buckets(buckets, desired_elo=1500, elo_buffer=200, time_controls=None):
+    low, high = desired_elo - elo_buffer, desired_elo + elo_buffer
+    return [(tc_class, bucket) for tc_class, bucket in sorted(buckets)
+            if (not time_controls or tc_class in time_controls) and
+            elo_bucket(low) <= bucket < max(high, elo_bucket(low) + 1)]
+
+
+# Merge the bucket trees covering desired_elo +/- elo_buffer into one tree, see window_buckets
+# Merged windows are cached as tree files and returned memory-mapped, so later runs and worker
+# processes asking for the same window share one page-cached copy instead of merging again
+def load_tree(desired_elo=1500, elo_buffer=200, starting_moves="none", time_controls=None, tree_dir=TREE_DIR,
+              cache=True):
+    prefix = starting_moves.split() if starting_moves != "none" else None
+    buckets = list_buckets(tree_dir)
+    paths = [buckets[key] for key in window_buckets(buckets, desired_elo, elo_buffer, time_controls)]
+
+    if cache:
+        window = json.dumps([paths, [move.lower() for move in prefix or []]]).encode()
+        window_path = os.path.join(tree_dir, "windows", hashlib.sha1(window).hexdigest() + ".tree")
+        if os.path.exists(window_path) and all(
+                os.path.getmtime(window_path) >= os.path.getmtime(path) for path in paths):
+            return OpeningTree.open(window_path)
+
+    # Bucket files are only read while merging, so map them instead of loading them
+    opening_tree = OpeningTree()
+    for path in paths:
+        opening_tree.merge(OpeningTree.open(path), prefix)
+
+    if cache:
+        os.makedirs(os.path.dirname(window_path), exist_ok=True)
+        opening_tree.save(window_path)
+        return OpeningTree.open(window_path)
+    return opening_tree
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Build the per elo bucket opening trees from opening_moves")
+    parser.add_argument("--tree-dir", default=TREE_DIR, help="directory for the bucket tree files")
+    parser.add_argument("--update", action="store_true",
+                        help="only merge the games of pgn_ids that aren't in the trees yet")
+    parser.add_argument("--pgn-id", type=int, nargs="+", help="pgn_ids to merge with --update (default: all new ones)")
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    if args.update:
+        with stage("update_buckets"):
+            update_from_db(args.pgn_id, args.tree_dir)
+    else:
+        with stage("build_buckets"):
+            build_buckets(args.tree_dir)
+    end_time = datetime.now()
+
+    print(f"{'update' if args.update else 'build'}_buckets runtime: {str(end_time - start_time)[:-3]}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,129 @@
+import time
+import queue
+import asyncio
+import atexit
+import threading
+import chess
+import chess.engine
+from stockfish_analysis import STOCKFISH_PATH, STOCKFISH_DEPTH, STOCKFISH_WORKERS, uci_options, score_to_eval
+from metrics import ENGINE_EVALS, ENGINE_EVAL_SECONDS
+
+
+# One UCI engine process driven with asyncio
+# The engine is started once and kept running, python-chess only sends ucinewgame before the first search,
+# so the hash table carries over between the positions it searches
+class UciEngine:
+    def __init__(self, threads=1):
+        self.threads = threads
+        self.engine = None
+
+    async def start(self):
+        transport, self.engine = await chess.engine.popen_uci(STOCKFISH_PATH)
+        await self.engine.configure(uci_options(self.engine, self.threads))
+
+    # Returns (eval, depth)
+    async def evaluate(self, fen, limit):
+        info = await self.engine.analyse(chess.Board(fen), limit)
+        return score_to_eval(info["score"]), info.get("depth", limit.depth)
+
+    # Evaluate the positions after each of moves (SAN) with one MultiPV search restricted to those moves
+    # (UCI searchmoves), returns {move: (eval, depth)} where depth is the depth reached below the position
+    async def evaluate_moves(self, fen, moves, limit):
+        board = chess.Board(fen)
+        root_moves = {board.parse_san(move): move for move in moves}
+        infos = await self.engine.analyse(board, limit, multipv=len(root_moves), root_moves=list(root_moves))
+
+        results = dict()
+        for info in infos:
+            if "pv" in info and info["pv"][0] in root_moves:
+                results[root_moves[info["pv"][0]]] = (score_to_eval(info["score"]),
+                                                      max(info.get("depth", limit.depth) - 1, 0))
+
+        # Lines can be missing if the search ended early, search those positions on their own
+        for move, san in root_moves.items():
+            if san not in results:
+                board.push(move)
+                results[san] = await self.evaluate(board.fen(), limit)
+                board.pop()
+        return results
+
+    async def quit(self):
+        if self.engine is not None:
+            await self.engine.quit()
+            self.engine = None
+
+
+# Warm UCI engines running on an event loop in a background thread, usable from synchronous code
+class UciEnginePool:
+    def __init__(self, workers=STOCKFISH_WORKERS, depth=STOCKFISH_DEPTH):
+        self.limit = chess.engine.Limit(depth=depth)
+        self._engines = [UciEngine() for _ in range(max(1, workers))]
+        self._started = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    async def _start(self):
+        if not self._started:
+            await asyncio.gather(*(engine.start() for engine in self._engines))
+            self._started = True
+
+    # Jobs of the same group go to the same engine in order, so related positions share its hash
+    async def _run_jobs(self, jobs, limit, results):
+        await self._start()
+        shards = [list() for _ in self._engines]
+        for index, (job_id, (fen, moves, group)) in enumerate(jobs.items()):
+            shards[hash(group if group is not None else index) % len(shards)].append((job_id, fen, moves))
+
+        async def run_shard(engine, shard):
+            for job_id, fen, moves in shard:
+                try:
+                    start = time.perf_counter()
+                    if moves is None:
+                        result = await engine.evaluate(fen, limit)
+                    else:
+                        result = await engine.evaluate_moves(fen, moves, limit)
+                except Exception as err:
+                    results.put(err)
+                    return
+                # A MultiPV search evaluates all of its moves at once, each gets an equal share of the time
+                positions = 1 if moves is None else len(result)
+                ENGINE_EVALS.inc(positions)
+                ENGINE_EVAL_SECONDS.observe((time.perf_counter() - start) / max(positions, 1), count=positions)
+                results.put((job_id, result))
+
+        await asyncio.gather(*(run_shard(engine, shard) for engine, shard in zip(self._engines, shards)))
+
+    # jobs: {job_id: (fen, moves, group)}, moves is a list of SAN moves or None to evaluate the position itself
+    # Yields (job_id, result) tuples in completion order, result is (eval, depth) or {move: (eval, depth)}
+    def run_jobs(self, jobs, limit=None):
+        results = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._run_jobs(jobs, limit or self.limit, results), self._loop)
+        for _ in range(len(jobs)):
+            result = results.get()
+            if isinstance(result, Exception):
+                future.cancel()
+                raise result
+            yield result
+        future.result()
+
+    def close(self):
+        async def quit_all():
+            await asyncio.gather(*(engine.quit() for engine in self._engines))
+
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(quit_all(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+
+# Pool shared by everything in this process, started on first use
+uci_pool = None
+
+
+def get_uci_pool():
+    global uci_pool
+    if uci_pool is None:
+        uci_pool = UciEnginePool()
+        atexit.register(uci_pool.close)
+    return uci_pool